@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+import pytest
+import astropy.io.fits as f
+
+#wirc_drp finds its masks and calibration files through WIRC_DRP (see the README), default it to this checkout.
+#Paths are built by appending to it, so it needs the trailing separator.
+os.environ.setdefault('WIRC_DRP', os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep)
+
+
+@pytest.fixture
+def write_raw_frames(tmp_path):
+    """
+    Write synthetic raw WIRC frames: unsigned 16 bit ints, which astropy stores as int16 with BZERO = 32768
+    like the real raw files. Returns a function taking the list of images and the exposure time, and
+    returning the list of file names. They go in the test's tmp_path unless another directory is given.
+    """
+    def write(images, exptime = 1., prefix = 'raw', directory = None):
+        directory = tmp_path if directory is None else directory
+        fnames = []
+        for i, image in enumerate(images):
+            header = f.Header()
+            header['EXPTIME'] = exptime
+            fname = str(directory / '{}_{:04d}.fits'.format(prefix, i))
+            f.PrimaryHDU(np.asarray(image, dtype = np.uint16), header = header).writeto(fname)
+            fnames.append(fname)
+        return fnames
+
+    return write
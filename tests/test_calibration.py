@@ -0,0 +1,156 @@
+import numpy as np
+import pytest
+import astropy.io.fits as f
+from astropy.stats import sigma_clip
+from scipy.ndimage import median_filter, shift
+
+from wirc_drp.utils import calibration
+
+
+@pytest.mark.parametrize('shape', [(64, 64), (63, 65)])
+def test_clip_mask_matches_sigma_clip(shape):
+    rng = np.random.default_rng(2)
+    image = rng.normal(1, 0.05, shape)
+    image[rng.integers(0, shape[0], 20), rng.integers(0, shape[1], 20)] = rng.uniform(2, 5, 20)
+    image[5, 6] = np.nan
+    image[7, 8] = np.inf
+
+    #a single median/mad_std clip, which is all clip_mask does
+    expected = sigma_clip(image, sigma = 5, maxiters = 1, cenfunc = 'median', stdfunc = 'mad_std').mask
+
+    np.testing.assert_array_equal(calibration.clip_mask(image, 5), expected)
+
+
+def test_read_row_blocks_ragged_last_block(write_raw_frames, tmp_path):
+    rng = np.random.default_rng(3)
+    images = [rng.integers(0, 60000, (70, 30)) for _ in range(3)]
+    fnames = write_raw_frames(images)
+    missing = str(tmp_path / 'missing.fits')
+
+    blocks = list(calibration.read_row_blocks(fnames[:2] + [missing] + fnames[2:], (70, 30), block_rows = 32))
+
+    assert [(rows.start, rows.stop) for rows, _ in blocks] == [(0, 32), (32, 64), (64, 70)]
+    stack = np.concatenate([block for _, block in blocks], axis = 1)
+    assert stack.dtype == np.float32
+    np.testing.assert_array_equal(stack[[0, 1, 3]], images)
+    #an unreadable file is all NaN, and drops out of a nanmedian combine
+    assert np.all(np.isnan(stack[2]))
+    np.testing.assert_array_equal(np.nanmedian(stack, axis = 0), np.median(images, axis = 0))
+
+
+@pytest.mark.parametrize('box_size', [4, 5])
+def test_median_at_pixels_matches_median_filter(box_size):
+    rng = np.random.default_rng(4)
+    image = rng.normal(1000, 30, (40, 50))
+    pixel_map = rng.random(image.shape) < 0.05
+    #corners and edges, where the boxes are reflected
+    pixel_map[[0, 0, -1, -1], [0, -1, 0, -1]] = True
+    pixel_map[1, :] = True
+    pixel_map[:, -2] = True
+
+    expected = median_filter(image, size = box_size)[pixel_map]
+
+    np.testing.assert_array_equal(calibration.median_at_pixels(image, pixel_map, box_size, chunk_size = 7), expected)
+
+
+@pytest.mark.parametrize('shape', [(64, 80), (63, 81)])
+def test_fft_shift_image_matches_spline_shift(shape):
+    y, x = np.indices(shape)
+    dy, dx = 0.37, -1.6
+    def blob(y0, x0):
+        return 1000*np.exp(-0.5*((y - y0)**2 + (x - x0)**2)/4**2)
+
+    shifted = calibration.fft_shift_image(blob(30, 40), dy, dx)
+
+    #same as the order 4 spline shift used without fft_shift, and as the blob drawn at the shifted position
+    np.testing.assert_allclose(shifted, shift(blob(30, 40), [dy, dx], order = 4), atol = 0.01)
+    np.testing.assert_allclose(shifted, blob(30 + dy, 40 + dx), atol = 1e-6)
+
+
+def test_master_flat_round_trip(write_raw_frames, tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (64, 64)
+    dark_fname = write_raw_frames([np.full(shape, 100)], prefix = 'dark')[0]
+    flats = write_raw_frames([rng.normal(5000, 20, shape) for _ in range(3)], prefix = 'flat')
+    assert f.getheader(flats[-1])['BZERO'] == 32768
+
+    flat_fname, bp_fname = calibration.masterFlat(flats, dark_fname, output_dir = str(tmp_path)+'/', n_jobs = 1)
+
+    master_flat = f.getdata(flat_fname)
+    bad_px = f.getdata(bp_fname)
+    assert 'BZERO' not in f.getheader(flat_fname)
+    assert abs(np.median(master_flat[bad_px == 0]) - 1) < 1e-3
+    assert np.abs(master_flat[bad_px == 0] - 1).max() < 0.05
+    assert bad_px.dtype == np.uint8 and set(np.unique(bad_px)) <= {0, 1}
+
+
+def test_sum_images_round_trip(write_raw_frames):
+    frames = write_raw_frames([np.full((16, 16), 1000) for _ in range(2)])
+
+    calibration.sum_images(frames)
+
+    summed_fname = frames[-1].split('.')[0]+'_summed.fits'
+    assert 'BZERO' not in f.getheader(summed_fname)
+    np.testing.assert_array_equal(f.getdata(summed_fname), 2000.)
+
+
+def test_master_dark_round_trip(write_raw_frames, tmp_path):
+    rng = np.random.default_rng(1)
+    #masterDark works on full 2048x2048 frames
+    darks = write_raw_frames([1000 + rng.integers(-5, 6, (2048, 2048)) for _ in range(3)], prefix = 'dark')
+
+    dark_fname, hp_fname = calibration.masterDark(darks, output_dir = str(tmp_path)+'/')
+
+    assert 'BZERO' not in f.getheader(dark_fname)
+    assert abs(np.median(f.getdata(dark_fname)) - 1000) <= 1
+    hot_px = f.getdata(hp_fname)
+    assert hot_px.dtype == np.uint8 and set(np.unique(hot_px)) <= {0, 1}
+
+
+def write_calibration_frames(tmp_path, shape, bad_pixel, dead_pixel):
+    #float32 master frames (stored big endian, like any fits file) and a bad pixel map with two bad pixels,
+    #one of which is dead (0 in the flat)
+    fnames = {}
+    bp_map = np.zeros(shape, dtype = np.uint8)
+    bp_map[bad_pixel] = 1
+    bp_map[dead_pixel] = 1
+    flat = np.full(shape, 2, dtype = np.float32)
+    flat[dead_pixel] = 0
+    for name, data in [('dark', np.full(shape, 100, dtype = np.float32)), ('flat', flat),
+                       ('bp', bp_map), ('hp', np.zeros(shape, dtype = np.uint8)), ('bkg', np.full(shape, 50, dtype = np.float32))]:
+        header = f.Header()
+        header['EXPTIME'] = 1.
+        fnames[name] = str(tmp_path / '{}.fits'.format(name))
+        f.PrimaryHDU(data, header = header).writeto(fnames[name])
+    return fnames
+
+
+def run_calibrate(write_raw_frames, tmp_path, use_gpu):
+    shape = (32, 32)
+    cal = write_calibration_frames(tmp_path, shape, bad_pixel = (3, 4), dead_pixel = (5, 6))
+    science = write_raw_frames([np.full(shape, 1100)], prefix = 'science', directory = tmp_path)
+
+    calibration.calibrate(science, cal['flat'], cal['dark'], cal['hp'], cal['bp'], clean_Bad_Pix = False,
+                          replace_nans = False, background_fname = cal['bkg'], use_gpu = use_gpu)
+
+    return f.getdata(science[0].split('.')[0]+'_calib.fits')
+
+
+def test_calibrate_round_trip(write_raw_frames, tmp_path):
+    redux = run_calibrate(write_raw_frames, tmp_path, use_gpu = False)
+
+    expected = np.full((32, 32), (1100 - 100)/2 - 50, dtype = np.float32)
+    expected[3, 4] = -50 #bad pixels are zeroed before the background is subtracted
+    expected[5, 6] = np.nan #unless their calibrated value isn't finite
+    np.testing.assert_allclose(redux, expected)
+
+
+def test_calibrate_gpu_matches_cpu(write_raw_frames, tmp_path):
+    pytest.importorskip('cupy')
+    cpu_dir = tmp_path / 'cpu'
+    gpu_dir = tmp_path / 'gpu'
+    cpu_dir.mkdir()
+    gpu_dir.mkdir()
+
+    np.testing.assert_allclose(run_calibrate(write_raw_frames, gpu_dir, use_gpu = True),
+                               run_calibrate(write_raw_frames, cpu_dir, use_gpu = False))
@@ -0,0 +1,51 @@
+import warnings
+
+import numpy as np
+import pytest
+from scipy.ndimage import median_filter
+
+from wirc_drp.utils import nbutils
+
+
+@pytest.mark.parametrize('n_images', [4, 5])
+def test_nanmedian3d_matches_numpy(n_images):
+    cube = np.random.default_rng(0).normal(1000, 30, (n_images, 20, 30)).astype(np.float32)
+    cube[0, 3, 4] = np.nan
+    cube[1:3, 5, 6] = np.nan
+    #all-NaN pixels, and a whole all-NaN column
+    cube[:, 7, 8] = np.nan
+    cube[:, :, 12] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) #All-NaN slice
+        expected = np.nanmedian(cube, axis = 0)
+
+    np.testing.assert_allclose(nbutils.nanmedian3d(cube), expected, rtol = 1e-6)
+
+
+@pytest.mark.parametrize('box_size', [4, 5])
+def test_nanmedian_at_pixels_matches_median_filter(box_size):
+    rng = np.random.default_rng(1)
+    image = rng.normal(1000, 30, (40, 50))
+    #random pixels plus the corners and a row and column at the edges, where the boxes are reflected
+    pixel_map = rng.random(image.shape) < 0.05
+    pixel_map[[0, 0, -1, -1], [0, -1, 0, -1]] = True
+    pixel_map[-2, :] = True
+    pixel_map[:, 0] = True
+    ys, xs = np.nonzero(pixel_map)
+
+    expected = median_filter(image, size = box_size)[ys, xs]
+
+    np.testing.assert_array_equal(nbutils.nanmedian_at_pixels(image, ys, xs, box_size), expected)
+
+
+def test_nanmedian_at_pixels_ignores_nans():
+    image = np.arange(100.).reshape(10, 10)
+    image[4:7, 4:7] = np.nan
+    image[1, 1] = np.nan
+
+    medians = nbutils.nanmedian_at_pixels(image, np.array([5, 1]), np.array([5, 1]), 3)
+
+    #the box around (5, 5) is all NaN, the one around (1, 1) has 8 good pixels and takes the upper middle one
+    assert np.isnan(medians[0])
+    assert medians[1] == np.sort(image[:3, :3][~np.isnan(image[:3, :3])])[4]
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from scipy.ndimage import shift
+from image_registration import chi2_shift
+
+from wirc_drp.utils import calibration
+
+
+#odd x odd, odd x even (a 2*80+1 row stack of four traces) and even x even
+@pytest.mark.parametrize('shape', [(41, 33), (161, 644), (20, 81), (40, 60)])
+def test_chi2_shift_to_reference_matches_chi2_shift(shape):
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    im0 = np.exp(-((yy - shape[0]/2.)**2 + (xx - shape[1]/2.)**2)/(2*3.**2)) + 0.01*rng.standard_normal(shape)
+    im2 = shift(im0, (1.3, -2.6), mode = 'wrap') + 0.01*rng.standard_normal(shape)
+
+    expected = chi2_shift(im0, im2, zeromean = True, return_error = True)
+    result = calibration.chi2_shift_to_reference(calibration.chi2_reference(im0), im2)
+
+    np.testing.assert_allclose(result[:2], expected[:2], atol = 1e-6)
+    np.testing.assert_allclose(result[2:], expected[2:], rtol = 1e-6)
@@ -0,0 +1,84 @@
+import numpy as np
+from scipy.ndimage import shift, zoom
+from scipy.signal import fftconvolve
+from scipy.optimize import least_squares
+from astropy.modeling import models, fitting
+
+from wirc_drp.utils import spec_utils
+
+
+def test_compute_polarization_propagates_nans():
+    rng = np.random.default_rng(0)
+    trace_spectra = np.empty((4, 3, 50))
+    trace_spectra[:,0,:] = np.arange(50.)
+    trace_spectra[:,1,:] = rng.uniform(900, 1100, (4, 50))
+    trace_spectra[:,2,:] = 10.
+    trace_spectra[0,1,7] = np.nan
+
+    wlQp, q, dq, wlUp, u, du = spec_utils.compute_polarization(trace_spectra)
+
+    Qp, Qm, Up, Um = trace_spectra[:,1,:]
+    np.testing.assert_allclose(q, (Qp-Qm)/(Qp+Qm), rtol = 1e-12)
+    np.testing.assert_allclose(u, (Up-Um)/(Up+Um), rtol = 1e-12)
+    #the (so far zero) errors are NaN wherever q or u is
+    np.testing.assert_array_equal(np.isnan(dq), np.isnan(q))
+    assert np.isnan(dq[7]) and np.all(dq[~np.isnan(q)] == 0)
+    np.testing.assert_array_equal(du, 0.)
+
+
+def test_smooth_spectra_rows_match_single_spectra():
+    spectra = np.random.default_rng(1).normal(1000, 30, (4, 200))
+    spectra[2,40] = np.nan
+
+    for kernel in ['Gaussian', 'box']:
+        smoothed = spec_utils.smooth_spectra(spectra, kernel, 5)
+        for row, spectrum in zip(smoothed, spectra):
+            np.testing.assert_allclose(row, spec_utils.smooth_spectra(spectrum, kernel, 5), rtol = 1e-12)
+
+
+def align_each_trace(traces_cube, ref_trace, oversampling):
+    #the original one trace at a time alignment, cross correlating each upsampled trace with the reference
+    ref = zoom(np.nan_to_num(ref_trace), oversampling, order = 1)
+    new_cube = np.zeros(traces_cube.shape)
+    shifts = []
+    for i, j in enumerate(np.nan_to_num(traces_cube)):
+        up_spec = zoom(j, oversampling, order = 1)
+        corr = fftconvolve(np.nan_to_num(ref/np.nanmax(ref)), np.nan_to_num((up_spec/np.nanmax(up_spec))[::-1]))
+        shift_size = np.nanargmax(corr) - len(ref) + 1
+        new_cube[i] = shift(j, shift_size/oversampling, order = 1)
+        shifts += [shift_size/oversampling]
+    return new_cube, np.array(shifts)
+
+
+def test_align_set_of_traces_matches_per_trace_alignment():
+    x = np.arange(120.)
+    offsets = np.array([0., 0.3, -1.7, 2.45])
+    traces = np.array([np.exp(-0.5*((x - 60 - dx)/3)**2) for dx in offsets])
+    traces[2,10] = np.nan
+
+    aligned, shifts = spec_utils.align_set_of_traces(traces, traces[0], return_shift = True)
+
+    expected_aligned, expected_shifts = align_each_trace(traces, traces[0], 10)
+    np.testing.assert_array_equal(shifts, expected_shifts)
+    np.testing.assert_allclose(aligned, expected_aligned, atol = 1e-12)
+    #each trace is moved back onto the reference, to within the 1/10 pixel oversampling
+    assert np.all(np.abs(shifts + offsets) <= 0.15)
+
+
+def test_moffat_lm_fit_matches_levmar_fitter():
+    poly_order = 2
+    y = np.arange(40.)
+    truth = models.Moffat1D(amplitude = 500., x_0 = 18.3, gamma = 3.2, alpha = 1.7) + models.Polynomial1D(poly_order, c0 = 20., c1 = 0.5, c2 = -0.01)
+    cross_section = truth(y) + np.random.default_rng(5).normal(0, 2, y.size)
+
+    #the starting point used in fitAcrossTrace_aligned
+    amplitude, x_0, gamma = np.max(cross_section), np.argmax(cross_section), 4.
+    moffat_resid, moffat_jac = spec_utils.make_moffat_resid(y, poly_order)
+    p0 = np.r_[amplitude, x_0, gamma, 1., np.zeros(poly_order+1)]
+    lm_fit = least_squares(moffat_resid, p0, jac = moffat_jac, method = 'lm', args = (cross_section,))
+
+    model = models.Moffat1D(amplitude = amplitude, x_0 = x_0, gamma = gamma, alpha = 1) + models.Polynomial1D(poly_order)
+    fitter_fit = fitting.LevMarLSQFitter()(model, y, cross_section)
+
+    np.testing.assert_allclose(lm_fit.x, fitter_fit.parameters, rtol = 1e-4, atol = 1e-4)
+    np.testing.assert_allclose(lm_fit.x[:4], truth.parameters[:4], rtol = 0.05)
@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+import astropy.io.fits as f
+
+from wirc_drp import wirc_object
+
+
+def make_raw_wirc_data(tmp_path, shape = (64, 64)):
+    #a synthetic unsigned 16 bit raw frame, stored with BZERO = 32768 like the real ones
+    header = f.Header()
+    header['AFT'] = 'J__(1.25)'
+    header['EXPTIME'] = 1.
+    raw_fname = str(tmp_path / 'raw.fits')
+    image = np.arange(np.prod(shape)).reshape(shape) % 60000
+    f.PrimaryHDU(image.astype(np.uint16), header = header).writeto(raw_fname)
+
+    return wirc_object.wirc_data(raw_filename = raw_fname, verbose = False), image
+
+
+def test_save_leaves_header_alone(tmp_path):
+    data, image = make_raw_wirc_data(tmp_path)
+    assert data.header['BZERO'] == 32768
+
+    data.save_wirc_object(str(tmp_path / 'saved.fits'), verbose = False)
+
+    #the scaling keys are dropped from the saved file, but not from the object's own header
+    assert data.header['BZERO'] == 32768
+    assert 'BZERO' not in f.getheader(str(tmp_path / 'saved.fits'))
+    np.testing.assert_array_equal(f.getdata(str(tmp_path / 'saved.fits')), image)
+
+
+def test_plot_cutouts_forgets_closed_figures():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    source = wirc_object.wircpol_source([10, 10], 'slitless', 0)
+    source.trace_images = np.random.default_rng(0).random((4, 40, 40))
+
+    source.plot_cutouts(fig_num = 101, show = False)
+    images = wirc_object.wircpol_source._cutout_figures[101][1]
+    #plotting into the same figure again reuses its images
+    source.plot_cutouts(fig_num = 101, show = False)
+    assert wirc_object.wircpol_source._cutout_figures[101][1] is images
+
+    plt.close(101)
+    source.plot_cutouts(fig_num = 102, show = False)
+    assert 101 not in wirc_object.wircpol_source._cutout_figures
+    plt.close(102)
+
+
+def make_source(rng):
+    #a source with thumbnails, trace spectra, Q and U, but no P, theta or calibrated spectra yet
+    source = wirc_object.wircpol_source([20.5, 30.5, 0.1, 0.2], 'slitless', 0)
+    source.trace_images = rng.random((4, 40, 40))
+    source.trace_images_DQ = rng.integers(0, 2, (4, 40, 40)).astype(float)
+    source.trace_spectra = rng.random((4, 3, 50)).astype(np.float32)
+    source.Q = rng.random((3, 50))
+    source.U = rng.random((3, 50))
+    source.spectra_widths = np.array([3.5, 3.5, 4., 4.])
+    source.spectra_angles = np.array([-45., -45., -44., -44.])
+    source.spectra_extracted = True
+    return source
+
+
+def test_make_source_columns():
+    data = wirc_object.wirc_data()
+    source = make_source(np.random.default_rng(0))
+
+    columns, lengths = data._make_source_columns(source)
+
+    #(wavelength, value, error) for the four traces, Q, U, P, theta and the four calibrated traces
+    assert len(columns) == 36
+    assert lengths == [50]*18 + [0]*18
+    np.testing.assert_array_equal(columns[3].array, source.trace_spectra[1,0])
+    np.testing.assert_array_equal(columns[13].array, source.Q[1])
+
+
+def save_and_load(data, tmp_path):
+    fname = str(tmp_path / 'saved.fits')
+    data.save_wirc_object(fname, verbose = False)
+    return wirc_object.wirc_data(wirc_object_filename = fname, verbose = False)
+
+
+def test_save_load_round_trip(tmp_path):
+    data, image = make_raw_wirc_data(tmp_path)
+    source = make_source(np.random.default_rng(0))
+    data.source_list = [source]
+    data.n_sources = 1
+    data.mark_bad("for the test")
+
+    loaded = save_and_load(data, tmp_path)
+
+    np.testing.assert_array_equal(loaded.full_image, image)
+    assert loaded.filter_name == 'J'
+    assert loaded.n_sources == 1 and loaded.bad_flag and loaded.bad_reason == "for the test"
+
+    loaded_source = loaded.source_list[0]
+    assert list(loaded_source.pos) == [20.5, 30.5, 0.1, 0.2]
+    assert loaded_source.slit_pos == 'slitless'
+    assert loaded_source.spectra_extracted and not loaded_source.polarization_computed
+    np.testing.assert_array_equal(loaded_source.trace_images, source.trace_images)
+    np.testing.assert_array_equal(loaded_source.trace_images_DQ, source.trace_images_DQ)
+    np.testing.assert_array_equal(loaded_source.spectra_widths, source.spectra_widths)
+    np.testing.assert_array_equal(loaded_source.spectra_angles, source.spectra_angles)
+    #the thumbnails of all the sources are gathered into one array on load
+    assert loaded.all_trace_images.shape == (1, 4, 40, 40)
+
+
+def test_load_source_spectra(tmp_path):
+    data, image = make_raw_wirc_data(tmp_path)
+    source = make_source(np.random.default_rng(1))
+    data.source_list = [source]
+    data.n_sources = 1
+
+    loaded_source = save_and_load(data, tmp_path).source_list[0]
+
+    np.testing.assert_array_equal(loaded_source.trace_spectra, source.trace_spectra)
+    np.testing.assert_array_equal(loaded_source.Q, source.Q)
+    np.testing.assert_array_equal(loaded_source.U, source.U)
+    #spectra that were never computed come back empty
+    assert loaded_source.P.shape == (3, 0)
+    assert loaded_source.theta.shape == (3, 0)
+    assert loaded_source.calibrated_trace_spectra.shape == (4, 3, 0)
+
+
+def write_calibrated_inputs(tmp_path, n_frames = 2, shape = (64, 64)):
+    #raw frames plus a master dark, a master flat and a bad pixel map to calibrate them with
+    rng = np.random.default_rng(7)
+    header = f.Header()
+    header['AFT'] = 'J__(1.25)'
+    header['EXPTIME'] = 1.
+    header['COADDS'] = 1
+
+    raw_fnames = []
+    for i in range(n_frames):
+        raw_fnames.append(str(tmp_path / 'raw_{}.fits'.format(i)))
+        f.PrimaryHDU(rng.integers(1000, 2000, shape).astype(np.uint16), header = header).writeto(raw_fnames[-1])
+
+    bp_map = (rng.random(shape) < 0.02).astype(np.uint8)
+    cal = {}
+    for key, data in [('dark_fn', np.full(shape, 100, dtype = np.float32)), ('flat_fn', rng.uniform(0.9, 1.1, shape).astype(np.float32)),
+                      ('bp_fn', bp_map)]:
+        cal[key] = str(tmp_path / '{}.fits'.format(key))
+        f.PrimaryHDU(data, header = header).writeto(cal[key])
+
+    return raw_fnames, cal
+
+
+def test_calibrate_batch_matches_serial_calibrate(tmp_path):
+    pytest.importorskip('joblib')
+    raw_fnames, cal = write_calibrated_inputs(tmp_path)
+
+    serial = [wirc_object.wirc_data(raw_filename = fname, verbose = False, **cal) for fname in raw_fnames]
+    for data in serial:
+        data.calibrate()
+
+    batch = wirc_object.wirc_data.calibrate_batch([wirc_object.wirc_data(raw_filename = fname, verbose = False, **cal) for fname in raw_fnames],
+                                                  n_jobs = 2)
+
+    assert len(batch) == len(serial)
+    for batch_data, serial_data in zip(batch, serial):
+        assert batch_data.calibrated
+        np.testing.assert_array_equal(batch_data.full_image, serial_data.full_image)
+        np.testing.assert_array_equal(batch_data.DQ_image, serial_data.DQ_image)
+        assert batch_data.header['FLAT_FN'] == cal['flat_fn']
+
+
+def test_batched_cutouts_match_per_source_cutouts():
+    rng = np.random.default_rng(8)
+    data = wirc_object.wirc_data()
+    data.full_image = rng.normal(100, 10, (2048, 2048)).astype(np.float32)
+    data.DQ_image = (rng.random((2048, 2048)) < 0.01).astype(int)
+    data.filter_name = 'J'
+    #one source with traces on the bars of doom, and one with traces running off the bottom of the detector
+    positions = [[1024, 1480], [300, 1000]]
+    data.source_list = [wirc_object.wircpol_source(pos, 'slitless', i+1) for i, pos in enumerate(positions)]
+    data.n_sources = len(positions)
+
+    data.get_source_cutouts()
+
+    assert data.all_trace_images.shape == (2, 4, 161, 161)
+    for i, pos in enumerate(positions):
+        source = wirc_object.wircpol_source(pos, 'slitless', i+1)
+        source.get_cutouts(data.full_image, data.DQ_image, 'J', sub_bar = True)
+
+        np.testing.assert_array_equal(data.source_list[i].trace_images, source.trace_images)
+        np.testing.assert_array_equal(data.source_list[i].trace_images_DQ, source.trace_images_DQ)
+        assert np.shares_memory(data.source_list[i].trace_images, data.all_trace_images)
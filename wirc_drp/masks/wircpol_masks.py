@@ -62,6 +62,9 @@ cross_mask_v2[cross_mask_v2 > 20] = 1
 cross_mask_ns = imread(wircpol_dir+'wirc_drp/masks/cross_mask/cross_mask_v2.003.png', as_gray = True)
 cross_mask_ns[cross_mask_ns < 20] = 0
 cross_mask_ns[cross_mask_ns > 20] = 1
+#The boolean version used to find sources, made once here rather than on every call. Read-only since it's shared.
+cross_mask_ns_bool = np.ascontiguousarray(cross_mask_ns, dtype = bool)
+cross_mask_ns_bool.flags.writeable = False
 
 ####Cross mask, with circular holes
 cross_mask_circ = imread(wircpol_dir+'wirc_drp/masks/cross_mask/cross_mask_v2.003.png', as_gray = True)
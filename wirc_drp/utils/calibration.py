@@ -12,15 +12,17 @@ import astropy.io.fits as f
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.linalg as la
-from astropy.stats import sigma_clip
 from scipy.stats import mode
-from scipy.ndimage import median_filter, shift, rotate
+from scipy import stats
+from scipy.ndimage import median_filter, uniform_filter, shift, rotate
 from scipy import interpolate
 import copy
 import cv2
 import os
 import warnings
 from image_registration import chi2_shift
+from image_registration.fft_tools import zoom
+from image_registration.chi2_shifts import chi2map_to_errors
 #from wircpol.DRP.reduction.constants import *
 from wirc_drp.constants import *
 #from pyklip import klip
@@ -29,9 +31,98 @@ from wirc_drp import version # For versioning (requires gitpython 'pip install g
 import copy
 from astropy.stats import sigma_clipped_stats
 
+#bottleneck provides much faster nan-aware reductions (nanmedian, nanmean, nansum) with
+#the same call signature as numpy, so fall back to numpy if it is not installed
+try:
+    import bottleneck as bn
+except ImportError:
+    warnings.warn("bottleneck is not installed, image combination will use the slower numpy functions.", ImportWarning)
+    bn = np
+
+#joblib is only used to process independent frames in parallel threads
+try:
+    from joblib import Parallel, delayed
+    no_joblib = False
+except ImportError:
+    no_joblib = True
+
+#cupy lets calibrate() run the per-frame arithmetic and bad pixel cleaning on a GPU
+try:
+    import cupy as cp
+    from cupyx.scipy.ndimage import median_filter as gpu_median_filter
+    no_cupy = False
+except ImportError:
+    no_cupy = True
+
+#numba-compiled median for the image stacks, nbutils.no_numba is True if numba is not installed
+from wirc_drp.utils import nbutils
+
+def clip_mask(image, sigma):
+    """
+    Return a boolean map of the pixels more than sigma robust standard deviations (1.4826*MAD)
+    away from the median of the image (True = clipped). NaNs and infs are flagged as clipped too.
+
+    The median and MAD aren't pulled around by the outliers, so unlike sigma_clip this only needs one
+    pass: a single sort of the finite pixels gives the median, and one more selection gives the MAD.
+    """
+    values = np.sort(image[np.isfinite(image)], axis = None)
+    n = values.size
+    med = 0.5*(values[(n-1)//2] + values[n//2])
+    std = 1.4826*bn.median(np.abs(values - med))
+
+    return ~((image >= med - sigma*std) & (image <= med + sigma*std))
+
+def read_row_blocks(file_list, shape, block_rows = 256):
+    """
+    Step through a list of same-sized fits images a block of rows at a time, so that they can be
+    combined without holding every full frame in memory at once.
+
+    Yields (rows, block), where rows is the slice of image rows and block is a float32 array of shape
+    (len(file_list), number of rows, shape[1]). Files that can't be read are left as NaN in the block.
+    """
+    hdulists = []
+    for fname in file_list:
+        try:
+            hdulists.append(f.open(fname, ignore_missing_end=True))
+        except:
+            print("Some error. Skipping file {}".format(fname))
+            hdulists.append(None)
+
+    try:
+        for r0 in range(0, shape[0], block_rows):
+            rows = slice(r0, min(r0+block_rows, shape[0]))
+            block = np.full((len(file_list), rows.stop-r0, shape[1]), np.nan, dtype=np.float32)
+            for i, hdulist in enumerate(hdulists):
+                if hdulist is None:
+                    continue
+                try:
+                    #section only reads (and scales) the requested rows from disk
+                    block[i] = hdulist[0].section[rows]
+                except:
+                    print("Some error. Skipping file {}".format(file_list[i]))
+                    hdulists[i] = None
+                    hdulist.close()
+            yield rows, block
+    finally:
+        for hdulist in hdulists:
+            if hdulist is not None:
+                hdulist.close()
+
+def output_hdulist(data, header):
+    """
+    A new single-HDU HDUList holding data, with a copy of header (usually that of one of the raw input files).
+
+    The raw frames are unsigned 16 bit ints stored with BZERO = 32768, so the BZERO/BSCALE keys are dropped
+    from the copy. Otherwise the processed frame would be read back offset by 32768.
+    """
+    header = header.copy()
+    header.remove('BZERO', ignore_missing = True)
+    header.remove('BSCALE', ignore_missing = True)
+    return f.HDUList([f.PrimaryHDU(data, header = header)])
+
 def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad_pix = 3, \
                 global_sig_bad_pix = 9, local_box_size = 11,  hotp_map_fname = None, verbose=False,
-                output_dir = None):
+                output_dir = None, n_jobs = -1):
 
 
     """
@@ -53,6 +144,7 @@ def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad
     sig_bad_pix: we define bad pixels as pixels with value more than sig_bad_pix*sqrt(variance) away from the median of the frame
     hotp_map_fname: file name of the hot pixel map from the dark frame, will be deprecated and let calibrate function deal with combinding
                     two maps
+    n_jobs: number of threads used to dark subtract and normalize the flats (-1 = all cores, 1 = serial). Needs joblib.
     """
 
     #Open the master dark
@@ -64,13 +156,8 @@ def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad
         print(("Subtracting {} from each flat file".format(master_dark_fname)))
     dark_exp_time = master_dark_hdu[0].header['EXPTIME']
 
-    #Open all files into a 3D array
-    #foo = np.empty((dark_shape[0],dark_shape[1],len(flat_list)))
-    foo = []
-
-    #Open first flat file to check exposure time and filter
-    first_flat_hdu = f.open(flat_list[0])
-    flat_exp_time = first_flat_hdu[0].header['EXPTIME']
+    #Read the header of the first flat file to check exposure time and filter
+    flat_exp_time = f.getheader(flat_list[0])['EXPTIME']
 
 
 
@@ -80,25 +167,47 @@ def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad
     else:
         factor = 1.
 
-    #We've already read it, so we'll stick it in foo
+    #The dark subtracted flats and their normalizations. Each flat is read only once, into a float32 stack.
+    #Frames that fail to load stay NaN, so they are ignored by the nanmedian below.
+    flats = np.full((len(flat_list),) + dark_shape, np.nan, dtype=np.float32)
+    norms = np.full(len(flat_list), np.nan)
 
-    print("Combining flat files")
-    for i in range(0,len(flat_list)):
-        try: 
+    def flat_norm(i):
+        """
+        Dark subtract the i-th flat and find its normalization. The flats are independent
+        so this can run in several threads at once (fits I/O and the median release the GIL).
+        """
+        try:
             #subtract dark for each file, then normalize by mode
-            hdu = f.open(flat_list[i],ignore_missing_end=True)
-            d_sub = hdu[0].data  - factor*master_dark
+            with f.open(flat_list[i],ignore_missing_end=True) as flat_hdu:
+                d_sub = np.subtract(flat_hdu[0].data, factor*master_dark, out = flats[i])
             #normalize
             if normalize == 'mode':
-                d_sub = d_sub/mode(d_sub, axis = None, nan_policy = 'omit')
+                norms[i] = mode(d_sub, axis = None, nan_policy = 'omit')[0]
             elif normalize == 'median':
-                d_sub = d_sub/np.nanmedian(d_sub)
-        #foo[:,:,i] = d_sub
-            foo.append(d_sub)
+                norms[i] = bn.nanmedian(d_sub)
+            else:
+                norms[i] = 1.
         except:
-            print("Some error. Skipping file {}".format(i))   
-    #Median combine frames
-    flat = np.median(foo, axis = 0)
+            print("Some error. Skipping file {}".format(i))
+
+    print("Combining flat files")
+    if no_joblib or n_jobs == 1:
+        for i in range(0,len(flat_list)):
+            flat_norm(i)
+    else:
+        Parallel(n_jobs = n_jobs, prefer = 'threads')(delayed(flat_norm)(i) for i in range(len(flat_list)))
+
+    #The header of the last flat is reused for the outputs
+    flat_header = f.getheader(flat_list[-1], ignore_missing_end=True)
+
+    #Median combine frames, a block of rows at a time so that the median's working copy stays small
+    flat = np.empty(dark_shape, dtype=np.float32)
+    for r0 in range(0, dark_shape[0], 256):
+        block = flats[:, r0:r0+256]
+        block /= norms[:,None,None]
+        flat[r0:r0+256] = bn.nanmedian(block, axis = 0)
+    del flats
 
     #Filter bad pixels
     #bad_px = sigma_clip(flat, sigma = sig_bad_pix) #old and bad
@@ -126,7 +235,7 @@ def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad
 
     #Global clipping here to reject awful pixels and dust, bad columns, etc
     pix_to_pix = flat/median_flat
-    global_bad_px = sigma_clip(pix_to_pix, sigma = global_sig_bad_pix).mask #9 seems to work best
+    global_bad_px = clip_mask(pix_to_pix, global_sig_bad_pix) #9 seems to work best
 
     #also set all 0 and negative pixels in flat as bad
     non_positive = flat <= 0
@@ -139,11 +248,11 @@ def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad
 
     #Normalize good pixel values
     if normalize == 'median':
-        norm_flat = flat/np.nanmedian(flat[~bad_px])
+        norm_flat = flat/bn.nanmedian(flat[~bad_px])
     elif normalize == 'mode':
         norm_flat = flat/mode(flat, axis = None, nan_policy = 'omit')
-    #Stick it back in the last hdu
-    hdu[0].data = norm_flat
+    #Stick it in a new hdu with the header of the last flat
+    hdu = output_hdulist(norm_flat, flat_header)
 
     #Add pipeline version and history keywords
     vers = version.get_version()
@@ -188,7 +297,7 @@ def masterFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_bad
         bp_outname = flat_list[-1].rsplit('.',1)[0]+"_bp_map.fits"
 
     ##### Now write the bad pixel map
-    hdu[0].data = bad_px.astype(int)#np.array(bad_px.mask, dtype=float)
+    hdu[0].data = bad_px.view(np.uint8) #np.array(bad_px.mask, dtype=float)
     #Parse the last fileanme
     # bp_outname = flat_list[-1].rsplit('.',1)[0]+"_bp_map.fits"
 
@@ -251,13 +360,13 @@ def masterPGFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_b
         print(("Subtracting {} from each flat file".format(master_dark_fname)))
     dark_exp_time = master_dark_hdu[0].header['EXPTIME']
 
-    #Open all files into a 3D array
-    foo = np.empty((dark_shape[0],dark_shape[1],len(flat_list)))
+    #Open all files into a 3D array, stacked along the first axis so each frame is contiguous
+    foo = np.empty((len(flat_list),dark_shape[0],dark_shape[1]), dtype=np.float32)
 
-    #Open first flat file to check exposure time
-    first_flat_hdu = f.open(flat_list[0])
-    flat_exp_time = first_flat_hdu[0].header['EXPTIME']
-    filter_name = first_flat_hdu[0].header['AFT']
+    #Read the header of the first flat file to check exposure time
+    first_flat_header = f.getheader(flat_list[0])
+    flat_exp_time = first_flat_header['EXPTIME']
+    filter_name = first_flat_header['AFT']
 
     #Open the zeroth order
     zeroth_order_flat = f.open(zeroth_order_flat_fname)[0].data
@@ -284,8 +393,8 @@ def masterPGFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_b
     print("Combining flat files")
     for i in range(0,len(flat_list)):
         #subtract dark for each file, then normalize by mode
-        hdu = f.open(flat_list[i])
-        d_sub = hdu[0].data  - factor*master_dark
+        with f.open(flat_list[i]) as hdu:
+            d_sub = hdu[0].data  - factor*master_dark
 
         #cleaned_d_sub = d_sub - ndimage.shift(zeroth_transmission_factor*zeroth_order_flat,offsets, order = 0) #full pixel shift
 
@@ -293,11 +402,11 @@ def masterPGFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_b
         if normalize == 'mode':
             d_sub = d_sub/mode(d_sub, axis = None, nan_policy = 'omit')
         elif normalize == 'median':
-            d_sub = d_sub/np.nanmedian(d_sub)
-        foo[:,:,i] = d_sub
+            d_sub = d_sub/bn.nanmedian(d_sub)
+        foo[i] = d_sub
 
     #Median combine frames
-    uncleaned_flat = np.median(foo, axis = 2)
+    uncleaned_flat = bn.nanmedian(foo, axis = 0)
 
     #For PG_flat, subtract zeroth order flat
 
@@ -331,7 +440,7 @@ def masterPGFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_b
 
     #Global clipping here to reject awful pixels and dust, bad columns, etc
     pix_to_pix = flat/median_flat
-    global_bad_px = sigma_clip(pix_to_pix, sigma = global_sig_bad_pix).mask #9 seems to work best
+    global_bad_px = clip_mask(pix_to_pix, global_sig_bad_pix) #9 seems to work best
 
     #also set all 0 and negative pixels in flat as bad
     non_positive = flat <= 0
@@ -344,7 +453,7 @@ def masterPGFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_b
 
     #Normalize good pixel values
     if normalize == 'median':
-        norm_flat = flat/np.nanmedian(flat[~bad_px])
+        norm_flat = flat/bn.nanmedian(flat[~bad_px])
     elif normalize == 'mode':
         norm_flat = flat/mode(flat, axis = None, nan_policy = 'omit')
     #Stick it back in the last hdu
@@ -428,7 +537,8 @@ def masterPGFlat(flat_list, master_dark_fname, normalize = 'median', local_sig_b
         bp_outname = flat_list[-1].rsplit('.',1)[0]+"_bp_map.fits"
 
     ##### Now write the bad pixel map
-    hdu[0].data = bad_px.astype(int)#np.array(bad_px.mask, dtype=float)
+    hdu[0].data = bad_px.view(np.uint8) #np.array(bad_px.mask, dtype=float)
+    hdu[0].scale('uint8') #unsigned bytes, drop any BZERO/BSCALE inherited from the raw header
     #Parse the last fileanme
     # bp_outname = flat_list[-1].rsplit('.',1)[0]+"_bp_map.fits"
 
@@ -466,42 +576,34 @@ def masterDark(dark_list, bad_pix_method = 'MAD', sig_hot_pix = 5, output_dir =
         sig_hot_pix: a cutoff for each bad_pix_method, recommend sigma_clipping < 9, MAD < 10, standard_deviation < ?.
 
     """
-    #Open all files into a 3D array
-    print("Creating a master dark")
-    dark_cube = np.empty((len(dark_list),2048,2048))
-    for i in range(len(dark_list)):
-        try:
-            hdu = f.open(dark_list[i])
-            dark_cube[i,:,:] = hdu[0].data
-            hdu.close()
-        except:
-            print('File Error; moving on to next file.')
-            dark_cube[i,:,:] = [([0]*2048)]*2048
-            continue
+    if bad_pix_method not in ['sigma_clipping', 'MAD', 'standard_deviation']:
+        print('%s is in valid, use MAD instead'%bad_pix_method)
+        bad_pix_method = 'MAD'
 
-    #Create the master dark
-    master_dark = np.median(dark_cube, axis = 0)
+    #Median combine the darks (and get the per-pixel MAD or standard deviation), a block of rows
+    #at a time to keep the memory use down for long lists of darks.
+    #Files that can't be read are NaN and ignored by the nan-aware statistics below
+    print("Creating a master dark")
+    master_dark = np.empty((2048,2048), dtype=np.float32)
+    pixel_stat = np.empty((2048,2048), dtype=np.float32)
+    for rows, block in read_row_blocks(dark_list, (2048,2048)):
+        master_dark[rows] = bn.nanmedian(block, axis = 0)
+        if bad_pix_method == 'MAD':
+            pixel_stat[rows] = bn.nanmedian(np.abs(block - master_dark[rows]), axis = 0) #compute MAD
+        elif bad_pix_method == 'standard_deviation':
+            pixel_stat[rows] = bn.nanstd(block, axis = 0)
 
     if bad_pix_method == 'sigma_clipping':
-        hot_px = sigma_clip(master_dark, sigma = sig_hot_pix)
-    elif bad_pix_method == 'MAD':
-        MAD = np.median(np.abs(dark_cube - master_dark ), axis = 0) #compute MAD
-        hot_px = sigma_clip(MAD, sigma = sig_hot_pix)
-    elif bad_pix_method == 'standard_deviation':
-        SD = np.std(dark_cube, axis = 0)
-        hot_px = sigma_clip(SD, sigma = sig_hot_pix)
+        hot_px = clip_mask(master_dark, sig_hot_pix)
     else:
-        print('%s is in valid, use MAD instead'%bad_pix_method)
-        MAD = np.median(np.abs(dark_cube - master_dark ), axis = 0) #compute MAD
-        hot_px = sigma_clip(MAD, sigma = sig_hot_pix)
-
+        hot_px = clip_mask(pixel_stat, sig_hot_pix)
 
     #zero_px = master_dark == 0.
 
-    bad_px = hot_px.mask #| zero_px
+    bad_px = hot_px #| zero_px
 
-    #Stick it back in the last hdu
-    hdu[0].data = master_dark
+    #Stick it in a new hdu with the header of the last dark
+    hdu = output_hdulist(master_dark, f.getheader(dark_list[-1]))
 
     #Add pipeline version and history keywords
     vers = version.get_version()
@@ -526,7 +628,7 @@ def masterDark(dark_list, bad_pix_method = 'MAD', sig_hot_pix = 5, output_dir =
 
     #Stick it back in the last hdu
     #hdu[0].data = np.array(bad_px, dtype=float)*2
-    hdu[0].data = np.array(bad_px, dtype=float) #this is for new version, separate maps from dark and flat
+    hdu[0].data = bad_px.view(np.uint8) #this is for new version, separate maps from dark and flat
 
     #Add history keywords
     #Add history keywords
@@ -553,55 +655,73 @@ def masterDark(dark_list, bad_pix_method = 'MAD', sig_hot_pix = 5, output_dir =
 
 
 def calibrate(science_list_fname, master_flat_fname, master_dark_fname, hp_map_fname, bp_map_fname, mask_bad_pixels = False,
-                clean_Bad_Pix=True, replace_nans=True, background_fname = None, outdir = None):
+                clean_Bad_Pix=True, replace_nans=True, background_fname = None, outdir = None, use_gpu = False):
     """
     Subtract dark; divide flat
     Bad pixels are masked out using the bad_pixel_map with 0 = bad and 1 = good pixels
 
+    use_gpu: if True (and cupy is installed) the calibration frames are uploaded to the GPU once, and the
+             arithmetic and bad pixel cleaning of each science frame is done there. Only the science frames
+             are copied back and forth.
     """
 
     #Get the list of science frames
     #science_list = np.loadtxt(science_list_fname, dtype=str)
     science_list = science_list_fname
 
-    #Open the master dark
-    master_dark_hdu = f.open(master_dark_fname)
-    master_dark = master_dark_hdu[0].data
+    #Open the master dark (the with blocks close each file as soon as it's been read)
+    with f.open(master_dark_fname) as master_dark_hdu:
+        master_dark = np.asarray(master_dark_hdu[0].data, dtype = np.float32)
+        dark_exp_time = master_dark_hdu[0].header['EXPTIME']
     dark_shape = np.shape(master_dark)
     print(("Subtracting {} from each flat file".format(master_dark_fname)))
-    dark_exp_time = master_dark_hdu[0].header['EXPTIME']
 
     #Open the master flat
-    master_flat_hdu = f.open(master_flat_fname)
-    master_flat = master_flat_hdu[0].data
+    with f.open(master_flat_fname) as master_flat_hdu:
+        master_flat = np.asarray(master_flat_hdu[0].data, dtype = np.float32)
     print(("Dividing each file by {}".format(master_flat_fname)))
-    dark_exp_time = master_dark_hdu[0].header['EXPTIME']
 
     #Open the bad pixel map from flat
-    bp_map_hdu = f.open(bp_map_fname)
-    bad_pixel_map = bp_map_hdu[0].data
+    bad_pixel_map = f.getdata(bp_map_fname)
     bad_pixel_map_bool = np.array(bad_pixel_map, dtype=bool)
     print(("Using bad pixel map {}".format(bp_map_fname)))
 
     #now if hot pixel map from dark is also given
     if hp_map_fname != None:
-        hp_map_hdu = f.open(hp_map_fname)
-        hot_pixel_map = hp_map_hdu[0].data
+        hot_pixel_map = f.getdata(hp_map_fname)
         bad_pixel_map_bool = np.logical_or(bad_pixel_map_bool, hot_pixel_map.astype(bool) )
 
 
     if background_fname != None:
-        background_hdu = f.open(background_fname)
-        background = background_hdu[0].data
+        #fits data is big endian, which cupy (and numba) can't take, so convert to native float32
+        background = np.asarray(f.getdata(background_fname), dtype = np.float32)
         print("Subtracting background frame {} from all science files".format(background_fname))
 
+    if use_gpu and no_cupy:
+        warnings.warn("cupy is not installed, calibrating on the CPU instead.", UserWarning)
+        use_gpu = False
+
+    if use_gpu:
+        #Upload the calibration frames once, they're reused for every science frame
+        master_dark = cp.asarray(master_dark)
+        master_flat = cp.asarray(master_flat)
+        bad_pixel_map_bool = cp.asarray(bad_pixel_map_bool)
+        if background_fname != None:
+            background = cp.asarray(background)
+        xp = cp
+    else:
+        xp = np
+
+    #The dark scaled to each exposure time seen so far. A sequence usually has a single exposure time,
+    #so the scaling only needs to be done once.
+    scaled_dark_cache = {}
 
     for fname in science_list:
         #Open the file
         print(("Calibrating {}".format(fname
             )))
         hdu = f.open(fname)
-        data = hdu[0].data
+        data = xp.asarray(np.asarray(hdu[0].data, dtype = np.float32))
         science_exp_time = hdu[0].header['EXPTIME']
 
         if dark_exp_time != science_exp_time:
@@ -610,10 +730,21 @@ def calibrate(science_list_fname, master_flat_fname, master_dark_fname, hp_map_f
         else:
             factor = 1.
 
-        #Subtract the dark, divide by flat
-        redux = ((data - factor*master_dark)/master_flat)
-        #get rid of crazy values at bad pixel
-        redux = redux*~bad_pixel_map_bool
+        scaled_dark = scaled_dark_cache.get(science_exp_time)
+        if scaled_dark is None:
+            scaled_dark = master_dark*xp.float32(factor)
+            scaled_dark_cache[science_exp_time] = scaled_dark
+
+        if not use_gpu and not nbutils.no_numba:
+            #Subtract the dark, divide by flat and mask the bad pixels in one compiled pass
+            redux = nbutils.apply_calib(np.asarray(data, dtype = np.float32), scaled_dark, master_flat, bad_pixel_map_bool)
+        else:
+            #Subtract the dark, divide by flat. Done in place in a single float32 buffer to avoid temporaries.
+            redux = xp.empty(data.shape, dtype = xp.float32)
+            xp.subtract(data, scaled_dark, out = redux)
+            xp.divide(redux, master_flat, out = redux)
+            #get rid of crazy values at bad pixel
+            redux *= ~bad_pixel_map_bool
 
         if background_fname != None:
             redux -= background
@@ -633,8 +764,11 @@ def calibrate(science_list_fname, master_flat_fname, master_dark_fname, hp_map_f
             # nan_map = ~np.isfinite(redux)
             # redux = cleanBadPix(redux, nan_map)
             # plt.imshow(redux-after)
-            nanmask = np.isnan(redux) #nan = True, just in case this is useful
-            redux = np.nan_to_num(redux)
+            redux = xp.nan_to_num(redux, copy = False)
+
+        #Bring the result back from the GPU
+        if use_gpu:
+            redux = cp.asnumpy(redux)
 
         #Put the cablibrated data back in the HDU list
         hdu[0].data = redux
@@ -709,6 +843,37 @@ def replace_bad_pix_with_interpolation(image, bad_pixel_map, interpolation_type
     return res
 
 
+def median_at_pixels(image, pixel_map, box_size, chunk_size = 65536):
+    """
+    Compute median_filter(image, size = box_size)[pixel_map], but only evaluate the median at the
+    pixels where pixel_map is True. This is much faster than filtering the full frame when only a
+    small fraction of the pixels are needed (e.g. bad pixels). Edges are handled like scipy's
+    default 'reflect' mode, so the result is identical to the full median filter.
+
+    Inputs:
+        image: 2D array
+        pixel_map: 2D boolean array of the same shape, True where the median is wanted
+        box_size: size of the square box for the median
+        chunk_size: number of pixels processed at once, to bound the memory used by the boxes
+    Output:
+        1D array of the medians, in the order of image[pixel_map]
+    """
+    half = box_size//2
+    padded = np.pad(image, ((half, box_size-1-half), (half, box_size-1-half)), mode = 'symmetric')
+    #a (ny, nx, box_size, box_size) view of the box around every pixel, no data is copied
+    boxes = np.lib.stride_tricks.as_strided(padded, shape = image.shape + (box_size, box_size),
+                                            strides = padded.strides*2, writeable = False)
+    ys, xs = np.nonzero(pixel_map)
+
+    #scipy's median_filter takes the element of rank n//2 (no averaging for even sized boxes)
+    rank = box_size*box_size//2
+    medians = np.empty(ys.size, dtype = image.dtype)
+    for start in range(0, ys.size, chunk_size):
+        these_boxes = boxes[ys[start:start+chunk_size], xs[start:start+chunk_size]].reshape(-1, box_size*box_size)
+        medians[start:start+chunk_size] = np.partition(these_boxes, rank, axis = 1)[:,rank]
+
+    return medians
+
 def cleanBadPix(redux_science, bad_pixel_map, method = 'median', replacement_box = 5, replace_constant = -99):
     """
     replace bad pixels by either median, interpolation, or a constant.
@@ -726,14 +891,27 @@ def cleanBadPix(redux_science, bad_pixel_map, method = 'median', replacement_box
     Output: 2D array of a cleaned image
 
     """
-    #add negative pixels to the bad pixel map
-    bad_pixel_map = np.logical_or(bad_pixel_map, redux_science <= 0)
+    #add negative pixels to the bad pixel map. Done into the freshly made comparison array so there's
+    #only one temporary, and the caller's map (reused for every frame in calibrate) isn't modified.
+    bad_pixels = np.less_equal(redux_science, 0)
+    bad_pixel_map = np.logical_or(bad_pixels, bad_pixel_map, out = bad_pixels)
     # im = np.copy(redux_science)
     # im[np.where(bad_pixel_map)[1]] = 0.
     if method == 'median':
-        med_fil = median_filter(redux_science, size = replacement_box)
-
-        cleaned = redux_science*~bad_pixel_map + med_fil*bad_pixel_map
+        #images already on the GPU (see calibrate) are filtered there
+        if not no_cupy and isinstance(redux_science, cp.ndarray):
+            med_fil = gpu_median_filter(redux_science, size = replacement_box)
+
+            cleaned = cp.where(bad_pixel_map, med_fil, redux_science)
+        elif not nbutils.no_numba:
+            #compiled median of the non-NaN pixels in the box around each bad pixel (numba needs native byte order)
+            cleaned = np.array(redux_science, dtype = redux_science.dtype.newbyteorder('='))
+            ys, xs = np.nonzero(bad_pixel_map)
+            cleaned[ys, xs] = nbutils.nanmedian_at_pixels(cleaned, ys, xs, replacement_box)
+        else:
+            #only the bad pixels need a median, so don't filter the whole frame
+            cleaned = np.array(redux_science)
+            cleaned[bad_pixel_map] = median_at_pixels(redux_science, bad_pixel_map, replacement_box)
 
     #elif method == 'interpolate':
 
@@ -746,20 +924,20 @@ def sum_images(filelist):
     Super simple sum of all the images in a list.
     """
 
-    nfiles = np.size(filelist)
-
-    print("Summing together {} files".format(nfiles))
+    print("Summing together {} files".format(len(filelist)))
 
-    ims = []
+    #The header of the last file is reused for the output
+    header = f.getheader(filelist[-1])
+    shape = (header['NAXIS2'], header['NAXIS1'])
 
+    #Add the images up one at a time so that only one of them is in memory, NaNs count as 0 like in nansum.
+    #The running sum is kept in float64 so long lists don't lose precision, and written out as float32.
+    sum_im = np.zeros(shape, dtype = np.float64)
     for fname in filelist:
-        hdu = f.open(fname)
-        ims.append(hdu[0].data)
+        im = f.getdata(fname)
+        sum_im += np.where(np.isnan(im), 0., im)
 
-    ims = np.array(ims)
-
-    sum_im = np.nansum(ims, axis=0)
-    hdu[0].data = sum_im
+    hdu = output_hdulist(sum_im.astype(np.float32), header)
 
     #Add pipeline version and history keywords
     vers = version.get_version()
@@ -777,11 +955,61 @@ def sum_images(filelist):
 
     hdu.writeto(outname, overwrite=True)
 
+def chi2_reference(im0, max_nsig = 1.1, nfitted = 2):
+    '''
+    Precompute everything chi2_shift_to_reference needs from the reference image im0,
+    so that registering many images to the same reference doesn't redo the reference FFT every time.
+
+    Returns a tuple of (conjugate of the FFT of the zero-mean reference, sum of its squares, delta-chi2 level for max_nsig)
+    '''
+    im0 = np.nan_to_num(im0 - np.nanmean(im0))
+    m_auto = stats.chi2.ppf(1-stats.norm.sf(max_nsig)*2, nfitted)
+
+    return np.conj(np.fft.rfft2(im0)), np.sum(im0**2), m_auto
+
+def chi2_shift_to_reference(reference, im2, max_auto_size = 512):
+    '''
+    The same as chi2_shift(im0, im2, zeromean=True, return_error=True) from image_registration,
+    (with the default 'auto' upsampling and wrapped boundary), but with the reference precomputed by chi2_reference.
+
+    Returns [dx, dy, dx_err, dy_err]
+    '''
+    conj_fft0, term3, m_auto = reference
+    im2 = np.nan_to_num(im2 - np.nanmean(im2))
+
+    #The chi2 map is sum(im2**2) + sum(im0**2) - 2*cross-correlation, centered on zero shift.
+    #ifftshift (not fftshift) puts zero shift at (ycen, xcen) below for odd sizes too, as in image_registration's chi2n_map
+    cross = np.fft.irfft2(conj_fft0*np.fft.rfft2(im2), s = im2.shape)
+    chi2 = np.sum(im2**2) + term3 - 2*np.fft.ifftshift(cross[::-1,::-1])
+
+    ylen, xlen = im2.shape
+    xcen = xlen/2 - (1 if xlen % 2 == 0 else 0.5)
+    ycen = ylen/2 - (1 if ylen % 2 == 0 else 0.5)
+    ymax, xmax = np.unravel_index(chi2.argmin(), chi2.shape)
+
+    #Pick the upsampling factor from the size of the region within m_auto of the minimum
+    sigmamax_area = (chi2 - chi2.min()) < m_auto
+    if sigmamax_area.sum() > 1:
+        yvals, xvals = np.nonzero(sigmamax_area)
+        size = max(xvals.max()-xvals.min(), yvals.max()-yvals.min())
+    else:
+        size = 1
+    upsample_factor = max(max_auto_size/2./size, 1)
+
+    #Zoom in on the minimum to get the sub-pixel shift and its errors
+    (yshifts, xshifts), chi2_ups = zoom.zoomnd(chi2, usfac = upsample_factor, outshape = [max_auto_size, max_auto_size],
+                                               offsets = [ymax-ycen, xmax-xcen], return_xouts = True)
+    errx_low, errx_high, erry_low, erry_high = chi2map_to_errors(chi2_ups, upsample_factor)
+    best = chi2_ups.argmin()
+
+    return [xcen-xshifts.flat[best], ycen-yshifts.flat[best], (errx_low+errx_high)/2., (erry_low+erry_high)/2.]
+
 def get_relative_image_offsets(cutouts, plot = False, save_cutout = False):
 
     '''
     This function returns the relative x and y offsets between a set of images,
-    determined through cross correlation (using the chi2_shift image_registration python packge)
+    determined through cross correlation (the chi2_shift method from the image_registration python packge,
+    with the FFT of the first image's traces computed only once)
     It really works best on either very bright sources or on sources that have been background subracted.
 
     Inputs:
@@ -803,21 +1031,19 @@ def get_relative_image_offsets(cutouts, plot = False, save_cutout = False):
     #The output
     offsets = []
 
-    #Stack the first image horizontally:
-    im0_stacks = []
-    for j in range(n_sources):
-        #Create the horizontal stack
+    #Stack the four traces of every source in every image horizontally, [m,n,l,4*l]
+    cutouts = np.asarray(cutouts, dtype = float)
+    stacks = cutouts.transpose(0,1,3,2,4).reshape(nfiles, n_sources, cutout_sz, 4*cutout_sz)
 
-        stack = np.concatenate((cutouts[0,j,0,:,:], cutouts[0,j,1,:,:], cutouts[0,j,2,:,:],cutouts[0,j,3,:,:]), axis=1)
+    #Smooth out the pixel-to-pixel noise with a 5x5 box, filtering all the stacks in one call.
+    #NaNs get no weight: smooth the image with them set to 0 and divide by the smoothed mask of finite pixels
+    finite = np.isfinite(stacks)
+    stacks = uniform_filter(np.where(finite, stacks, 0.), size=(1,1,5,5), mode='constant')
+    weights = uniform_filter(finite.astype(float), size=(1,1,5,5), mode='constant')
+    stacks /= np.maximum(weights, 1e-6)
 
-        #Get rid of outlying pixels
-        tmp = np.copy(stack)*0.
-        stack = median_filter(stack, size=5, output=tmp)
-        stack = tmp
-        im0_stacks.append(stack)
-
-    #Make the list a numpy array
-    im0_stacks = np.array(im0_stacks)
+    im0_stacks = stacks[0]
+    references = [chi2_reference(im0_stacks[j]) for j in range(n_sources)]
     #plt.imshow(im0_stacks[0], origin = 'lower')
     #plt.show()
 
@@ -825,18 +1051,12 @@ def get_relative_image_offsets(cutouts, plot = False, save_cutout = False):
     for i in np.arange(0,nfiles): #include the first frame as a sanity check
         img_offset = []
         for j in range(n_sources):
-            #Stack this cutout
-            horiz_stack = np.concatenate((cutouts[i,j,0,:,:], cutouts[i,j,1,:,:], cutouts[i,j,2,:,:],cutouts[i,j,3,:,:]), axis=1)
-
-            #To get rid of bad pixels
-            tmp = np.copy(horiz_stack)*0.
-            horiz_stack = median_filter(horiz_stack, size=5, output=tmp) #To get rid of mixed
-            horiz_stack = tmp
+            horiz_stack = stacks[i,j]
 
             #Calculate the image offsets
             #plt.imshow(horiz_stack, origin = 'lower')
             #plt.show()
-            shifted = chi2_shift(im0_stacks[j,:,:],horiz_stack, zeromean=True, verbose=False, return_error=True)
+            shifted = chi2_shift_to_reference(references[j], horiz_stack)
             img_offset.append(shifted)
 
         offsets.append(img_offset)
@@ -851,8 +1071,23 @@ def get_relative_image_offsets(cutouts, plot = False, save_cutout = False):
         #print( img_offset[0][1]-0.5, img_offset[0][0]  )
     return offsets
 
+def fft_shift_image(image, dy, dx):
+    '''
+    Shift an image by a (sub-pixel) amount using a phase ramp in Fourier space,
+    equivalent to scipy.ndimage.shift(image, [dy, dx]) for band-limited images but without the spline ringing.
+    Note that pixels shifted off one edge wrap around to the other.
+    '''
+    ny, nx = np.shape(image)
+    ky = np.fft.fftfreq(ny)[:,None]
+    kx = np.fft.rfftfreq(nx)[None,:]
+
+    image_fft = np.fft.rfft2(image)
+    image_fft *= np.exp(-2j*np.pi*(ky*dy + kx*dx))
+
+    return np.fft.irfft2(image_fft, s = (ny, nx))
+
 def register_and_combine_raw(direct_image_fname, spec_list_fname, datadir = "", background_img_fname = None, locations= None, cutouts = None, quiet=True,
-                            combine = 'median', save_fits=True, save_each = False, plot=False):
+                            combine = 'median', save_fits=True, save_each = False, plot=False, fft_shift = False):
     #
     # This functions reads in a list of science frames, performs cross correlation and then shifts and combines them
     #
@@ -872,6 +1107,8 @@ def register_and_combine_raw(direct_image_fname, spec_list_fname, datadir = "",
     #                                 to determine image offsets. However the science images will still be read and shifted.
     #     save_fits               -   (keyword) if set to true then save the registered and combined images
     #     save_each               -   (keyword) if true then save the aligned version of each input image.
+    #     fft_shift               -   (keyword) if true then align the images with a Fourier phase shift (fft_shift_image)
+    #                                 instead of a 4th order spline interpolation. This is faster on full frames, but wraps around the edges.
 
     # Outputs
     #     spec_image              -   the name of the output file where the combined image was saved
@@ -879,26 +1116,27 @@ def register_and_combine_raw(direct_image_fname, spec_list_fname, datadir = "",
     #If locations == None then automatically find the source locations.
     if locations == None:
         #The mask - required to find the locations
-        mask = cross_mask_ns.astype('bool')
+        mask = cross_mask_ns_bool
 
         #### Read in the direct image to get the source locations
         direct_image = f.open(direct_image_fname)[0].data
         locations = coarse_regis.coarse_regis(direct_image, mask, threshold_sigma = 5, guess_seeing = 4, plot = plot)
 
     #The number of sources found
-    n_sources = np.shape(locations[0,:])[0]+1
+    n_sources = len(locations)
 
     #For the cross correlation to work reliably a background image should be supplied.
     if background_img_fname != None:
-        bkg_img = f.open(background_img_fname)[0].data
-        bkg_itime = f.open(background_img_fname)[0].header["EXPTIME"]
+        with f.open(background_img_fname) as bkg_hdulist:
+            bkg_img = bkg_hdulist[0].data
+            bkg_itime = bkg_hdulist[0].header["EXPTIME"]
 
     #Get the list of spectral images
     spec_images = a.read(spec_list_fname, format = "fast_no_header")['col1']
     n_images = np.size(spec_images)
 
     #An array that will hold all the images
-    spec_stack = np.zeros([n_images, detector_size, detector_size])
+    spec_stack = np.zeros([n_images, detector_size, detector_size], dtype = np.float32)
 
     cutouts = []
 
@@ -910,6 +1148,8 @@ def register_and_combine_raw(direct_image_fname, spec_list_fname, datadir = "",
         spectral_hdulist = f.open(datadir+i)
         spectral_image = np.nan_to_num(spectral_hdulist[0].data)
         scitime = spectral_hdulist[0].header["EXPTIME"]
+        #Done with the file on disk, the header stays available for writing out later
+        spectral_hdulist.close()
 
         #TODO: ADD CHECK TO MAKE SURE FILES HAVE SAME EXPOSURE TIME.
 
@@ -980,7 +1220,10 @@ def register_and_combine_raw(direct_image_fname, spec_list_fname, datadir = "",
         #Now re-align the images
         #print('Max value ', np.max(spec_stack[i,:,:]))
         #spec_stack[i,:,:] = klip.align_and_scale(spec_stack[i,:,:], new_center, old_center=old_center, scale_factor=1,dtype=float)
-        spec_stack[i,:,:] = shift(spec_stack[i,:,:], [-dy,-dx], order = 4)
+        if fft_shift:
+            spec_stack[i,:,:] = fft_shift_image(spec_stack[i,:,:], -dy, -dx)
+        else:
+            spec_stack[i,:,:] = shift(spec_stack[i,:,:], [-dy,-dx], order = 4)
         #print('NaNs',len(spec_stack[i,:,:][np.isnan(spec_stack[i,:,:])]))
 
         #if save_each, save the aligned version of each file by adding _aligned at the end of the name before .fits
@@ -1001,14 +1244,16 @@ def register_and_combine_raw(direct_image_fname, spec_list_fname, datadir = "",
 
     #Collapse the image by it's sum, median, or mean based on 'combine' parameter. Default is median.
     if combine == 'sum':
-        comb_spec = np.nansum(spec_stack, axis=0)
-    elif combine == 'median':
-        comb_spec = np.nanmedian(spec_stack, axis = 0)
+        comb_spec = bn.nansum(spec_stack, axis=0)
     elif combine == 'mean':
-        comb_spec = np.nanmean(spec_stack, axis = 0)
+        comb_spec = bn.nanmean(spec_stack, axis = 0)
     else:
-        print(combine+' is not an option. Use median instead.')
-        comb_spec = np.nanmedian(spec_stack, axis = 0)
+        if combine != 'median':
+            print(combine+' is not an option. Use median instead.')
+        if nbutils.no_numba:
+            comb_spec = bn.nanmedian(spec_stack, axis = 0)
+        else:
+            comb_spec = nbutils.nanmedian3d(spec_stack)
 
 
     dx_list = np.array(dx_list)
@@ -1048,8 +1293,16 @@ def shiftSub(image, slit_gap1, slit_gap2):
     Create a full frame background subtracted image. The background image is an average between a frame shifted
     to +x by slit_gap1 pixel, and -x by slit_gap2 pixel. This is then subtracted off of the image.
     """
-    bkg = (shift(image,(0,slit_gap1), order = 3) + shift(image,(0,-slit_gap2), order = 3))/2.
-    return image - bkg
+    #Two full frame buffers, everything after the shifts is done in place in them
+    dtype = np.result_type(image, np.float32)
+    bkg = np.empty(np.shape(image), dtype = dtype)
+    other_side = np.empty(np.shape(image), dtype = dtype)
+    shift(image,(0,slit_gap1), order = 3, output = bkg)
+    shift(image,(0,-slit_gap2), order = 3, output = other_side)
+
+    np.add(bkg, other_side, out = bkg)
+    np.multiply(bkg, 0.5, out = bkg)
+    return np.subtract(image, bkg, out = bkg)
 
 def destripe_raw_image(image):
     '''
@@ -1191,10 +1444,10 @@ def remove_correlated_channel_noise(image,n_channels = 8, mask = None):
 
 
     #Now take the median across all channels
-    ll_channel_median = np.nanmedian(ll_channel_median,axis=0)
-    lr_channel_median = np.nanmedian(lr_channel_median,axis=0)
-    ul_channel_median = np.nanmedian(ul_channel_median,axis=0)
-    ur_channel_median = np.nanmedian(ur_channel_median,axis=0)
+    ll_channel_median = bn.nanmedian(ll_channel_median,axis=0)
+    lr_channel_median = bn.nanmedian(lr_channel_median,axis=0)
+    ul_channel_median = bn.nanmedian(ul_channel_median,axis=0)
+    ur_channel_median = bn.nanmedian(ur_channel_median,axis=0)
 
     #Copy the original again for the output image
     image_copy = copy.deepcopy(image)
@@ -1141,13 +1141,14 @@ def cutout_trace_thumbnails(image, locations, flip = True, filter_name = 'J', su
             xlow = int(traceLocation[j][1]-cutout_size)
             xhigh = int(traceLocation[j][1]+cutout_size+1 )
 
-            image_new = copy.deepcopy(image)
+            #Only the thumbnail is copied below, the full frame is left alone
+            image_new = image
 
             #Checking and compensating for out of bounds
             if (ylow < 0) or (xlow < 0) or (yhigh > 2048) or (xhigh > 2048):
                 
                 pad_width = np.max([(0.-ylow),(0.-xlow), (yhigh-2048), (xhigh-2048)]).astype(int)
-                image_new = np.pad(image_new, pad_width, 'constant')
+                image_new = np.pad(image, pad_width, 'constant')
 
                 if True:
                     print("Cutout will slice outside of array, padding {} pixels with zeros".format(pad_width))
@@ -1165,7 +1166,7 @@ def cutout_trace_thumbnails(image, locations, flip = True, filter_name = 'J', su
             cutout = np.s_[ylow:yhigh,xlow:xhigh]
         
             #cut the spectral image into a thumbnail containing the trace
-            thumbnail = copy.deepcopy(image_new)[cutout]
+            thumbnail = np.array(image_new[cutout])
                        
             #flip the thumbnail so that it's in the Q+ orientation (from top left to bottom right)
             if flip and mode=='pol': 
@@ -1195,9 +1196,9 @@ def cutout_trace_thumbnails(image, locations, flip = True, filter_name = 'J', su
                         if j == 0: 
                             print("Source {}'s traces will hit the vertical bar of doom, compensating by subtracting the median of the edges of each row".format(k+1))
 
-                        for xind in range(np.shape(thumbnail)[1]):
-                            sub_length = 20 #The number of pixels at the beginning and end to estimate the background
-                            thumbnail[:,xind] -= np.nanmedian(np.concatenate([thumbnail[:sub_length-1,xind],thumbnail[-(sub_length):,xind]]))
+                        #subtract from each column the median of its ends
+                        sub_length = 20 #The number of pixels at the beginning and end to estimate the background
+                        thumbnail -= np.nanmedian(np.concatenate([thumbnail[:sub_length-1,:],thumbnail[-(sub_length):,:]], axis = 0), axis = 0)[None,:]
 
 
                     
@@ -1205,9 +1206,9 @@ def cutout_trace_thumbnails(image, locations, flip = True, filter_name = 'J', su
                         if j == 0: 
                             print("Source {}'s traces will hit the horizontal bar of doom".format(k+1))
 
-                        for yind in range(np.shape(thumbnail)[0]):
-                            sub_length = 20 #The number of pixels at the beginning and end to estimate the background
-                            thumbnail[yind,:] -= np.nanmedian(np.concatenate([thumbnail[yind,:sub_length-2],thumbnail[yind,-(sub_length):]]))
+                        #subtract from each row the median of its ends
+                        sub_length = 20 #The number of pixels at the beginning and end to estimate the background
+                        thumbnail -= np.nanmedian(np.concatenate([thumbnail[:,:sub_length-2],thumbnail[:,-(sub_length):]], axis = 1), axis = 1)[:,None]
 
 
             thumbnails.append(thumbnail)
@@ -0,0 +1,257 @@
+###Numba-compiled versions of the slow pixel-by-pixel operations in the WIRC+Pol data reduction.
+###numba is optional: check no_numba and fall back to the numpy/bottleneck equivalent if it's True.
+import numpy as np
+
+try:
+    from numba import njit, prange, set_num_threads
+    no_numba = False
+except ImportError:
+    no_numba = True
+
+    #Without numba the functions below still run, just as (slow) plain python
+    def njit(*args, **kwargs):
+        return lambda func: func
+    prange = range
+
+    def set_num_threads(n):
+        pass
+
+
+@njit(cache=True)
+def _nanmedian_1d(values, buffer):
+    """
+    Median of the non-NaN elements of the 1D array values, NaN if they are all NaN.
+    buffer is scratch space at least as long as values.
+    """
+    n_good = 0
+    for k in range(values.size):
+        v = values[k]
+        if not np.isnan(v):
+            #insertion sort, the stacks are only a few tens of frames deep
+            m = n_good
+            while m > 0 and buffer[m-1] > v:
+                buffer[m] = buffer[m-1]
+                m -= 1
+            buffer[m] = v
+            n_good += 1
+
+    if n_good == 0:
+        return np.nan
+
+    half = n_good // 2
+    if n_good % 2:
+        return buffer[half]
+    return (buffer[half-1] + buffer[half]) / 2
+
+
+@njit(parallel=True, cache=True)
+def nanmedian3d(cube):
+    """
+    Equivalent to np.nanmedian(cube, axis = 0) for a cube of shape (n_images, ny, nx),
+    with the rows of the output image spread over all cores.
+    """
+    n_images, ny, nx = cube.shape
+    out = np.empty((ny, nx), dtype=cube.dtype)
+
+    for i in prange(ny):
+        #copy the row so that each pixel's stack is contiguous in memory
+        row = np.ascontiguousarray(cube[:,i,:].T)
+        buffer = np.empty(n_images, dtype=cube.dtype)
+        for j in range(nx):
+            out[i,j] = _nanmedian_1d(row[j], buffer)
+
+    return out
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def apply_calib(data, scaled_dark, flat, bad_pixel_map):
+    """
+    (data - scaled_dark)/flat in a single pass, with the pixels in bad_pixel_map multiplied by 0
+    (so they're 0, or NaN where the calibrated value isn't finite, as with redux*~bad_pixel_map).
+    All arrays must be in native byte order (fits data is big endian, so convert it first).
+    Returns a float32 image.
+    """
+    ny, nx = data.shape
+    out = np.empty((ny, nx), dtype=np.float32)
+
+    for i in prange(ny):
+        for j in range(nx):
+            value = (data[i,j] - scaled_dark[i,j]) / flat[i,j]
+            if bad_pixel_map[i,j]:
+                value *= 0.
+            out[i,j] = value
+
+    return out
+
+
+def _dark_flat_kernel(image, dark, factor, flat):
+    for i in prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            value = image[i,j]
+            if dark is not None:
+                value -= factor*dark[i,j]
+            if flat is not None:
+                value /= flat[i,j]
+            image[i,j] = value
+
+#On a single 2048x2048 frame the threading overhead is about as large as the work, so serial is the default
+_dark_flat_serial = njit(cache=True, nogil=True, error_model='numpy')(_dark_flat_kernel)
+_dark_flat_parallel = njit(parallel=True, cache=True, nogil=True, error_model='numpy')(_dark_flat_kernel)
+
+def dark_flat_correct(image, dark = None, factor = 1., flat = None, parallel = False):
+    """
+    Subtract factor*dark from image and divide it by flat, in place and in a single pass.
+    Either dark or flat can be None to skip that step.
+    All arrays must be in native byte order (fits data is big endian, so convert it first).
+    """
+    if parallel:
+        _dark_flat_parallel(image, dark, factor, flat)
+    else:
+        _dark_flat_serial(image, dark, factor, flat)
+
+    return image
+
+
+@njit(cache=True)
+def _reflect(k, n):
+    #Index into an axis of length n with scipy.ndimage's 'reflect' edge mode (d c b a | a b c d | d c b a)
+    if k < 0:
+        return -k - 1
+    if k >= n:
+        return 2*n - k - 1
+    return k
+
+
+@njit(parallel=True, cache=True)
+def nanmedian_at_pixels(image, ys, xs, box_size):
+    """
+    The median of the box_size x box_size box around each of the pixels (ys[k], xs[k]) of image, ignoring NaNs
+    (NaN if the whole box is NaN). The box and the edge handling are the same as in scipy's median_filter,
+    including taking the upper of the two middle values when the number of good pixels is even,
+    so without NaNs this matches median_filter(image, size = box_size)[ys, xs].
+    Returns a float64 array of the same length as ys.
+    """
+    ny, nx = image.shape
+    half = box_size // 2
+    out = np.empty(ys.size, dtype=np.float64)
+
+    for k in prange(ys.size):
+        buffer = np.empty(box_size*box_size, dtype=np.float64)
+        n_good = 0
+        for dy in range(box_size):
+            y = _reflect(ys[k] - half + dy, ny)
+            for dx in range(box_size):
+                v = np.float64(image[y, _reflect(xs[k] - half + dx, nx)])
+                if v == v:
+                    #insertion sort, the boxes only hold a few tens of pixels
+                    m = n_good
+                    while m > 0 and buffer[m-1] > v:
+                        buffer[m] = buffer[m-1]
+                        m -= 1
+                    buffer[m] = v
+                    n_good += 1
+
+        if n_good == 0:
+            out[k] = np.nan
+        else:
+            out[k] = buffer[n_good // 2]
+
+    return out
+
+
+@njit(cache=True, error_model='numpy')
+def _normalized_difference(wl_plus, plus, wl_minus, minus):
+    #minus is interpolated onto the wavelengths of plus, then (plus-minus)/(plus+minus) in one pass
+    minus_at_plus = np.interp(wl_plus, wl_minus, minus)
+    out = np.empty(plus.size, dtype=np.float64)
+    for i in range(plus.size):
+        out[i] = (plus[i] - minus_at_plus[i]) / (plus[i] + minus_at_plus[i])
+    return out
+
+def normalized_difference(wl_plus, plus, wl_minus, minus):
+    """
+    The normalized difference (plus - minus)/(plus + minus) of two 1D spectra, e.g. Qp and Qm for stokes q,
+    with minus linearly interpolated onto the wavelengths wl_plus of plus first (as np.interp).
+    """
+    #numba needs native byte order, and a single dtype
+    arrays = [np.asarray(a, dtype=np.float64) for a in (wl_plus, plus, wl_minus, minus)]
+    return _normalized_difference(*arrays)
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def _weighted_sum_extraction(cutout, trace, psf, ron, gain):
+    ny, nx = cutout.shape
+    half_y = psf.shape[0] // 2
+    half_x = psf.shape[1] // 2
+    spec = np.zeros(trace.size)
+    var = np.zeros(trace.size)
+
+    for i in prange(trace.size):
+        #columns where the trace is not in the image are left at 0
+        if not (trace[i] >= 0 and trace[i] <= ny):
+            continue
+        #the psf is centred on (int(trace[i]), i), and cropped at the edges of the cutout
+        y = int(trace[i])
+        flux = 0.
+        weights = 0.
+        variance = 0.
+        for r in range(max(y - half_y, 0), min(y - half_y + psf.shape[0], ny)):
+            for c in range(max(i - half_x, 0), min(i - half_x + psf.shape[1], nx)):
+                w = psf[r - y + half_y, c - i + half_x]
+                flux += w*cutout[r,c]
+                weights += w
+                variance += w*(cutout[r,c]/gain + (ron/gain)**2)
+        spec[i] = flux / weights
+        var[i] = variance
+
+    #flip so long wavelength is to the right
+    return spec[::-1].copy(), var[::-1].copy()
+
+def weighted_sum_extraction(cutout, trace, psf, ron = 12, gain = 1.2):
+    """
+    Compiled version of spec_utils.weighted_sum_extraction, with the columns spread over all cores.
+    For each column x of cutout, sums the pixels weighted by psf centred on (trace[x], x) and normalized by the
+    sum of the weights, and the variance from photon and read noise. Returns the (flipped) spectrum and variance.
+    """
+    #numba needs native byte order, and a single dtype
+    cutout, trace, psf = [np.asarray(a, dtype=np.float64) for a in (cutout, trace, psf)]
+    return _weighted_sum_extraction(cutout, trace, psf, float(ron), float(gain))
+
+
+@njit(cache=True, error_model='numpy')
+def moffat_poly_residual(params, y, vander, data):
+    """
+    Residual (model - data) of astropy's Moffat1D + Polynomial1D on the grid y, with
+    params = [amplitude, x_0, gamma, alpha, c0, c1, ...] and vander[i,k] = y[i]**k.
+    """
+    amplitude, x_0, gamma, alpha = params[0], params[1], params[2], params[3]
+    out = np.empty(y.size)
+    for i in range(y.size):
+        u = (y[i] - x_0) / gamma
+        value = amplitude * (1. + u*u)**(-alpha)
+        for k in range(vander.shape[1]):
+            value += params[4+k] * vander[i,k]
+        out[i] = value - data[i]
+    return out
+
+
+@njit(cache=True, error_model='numpy')
+def moffat_poly_jacobian(params, y, vander, data):
+    """
+    Analytic jacobian of moffat_poly_residual with respect to params, of shape (y.size, params.size).
+    data is unused, it is only there so that the residual and jacobian take the same arguments.
+    """
+    amplitude, x_0, gamma, alpha = params[0], params[1], params[2], params[3]
+    jac = np.empty((y.size, params.size))
+    for i in range(y.size):
+        u = (y[i] - x_0) / gamma
+        b = 1. + u*u
+        profile = b**(-alpha)
+        d_u = 2. * amplitude * alpha * u * profile / b / gamma
+        jac[i,0] = profile
+        jac[i,1] = d_u
+        jac[i,2] = d_u * u
+        jac[i,3] = -amplitude * profile * np.log(b)
+        for k in range(vander.shape[1]):
+            jac[i,4+k] = vander[i,k]
+    return jac
@@ -19,6 +19,7 @@ from scipy.ndimage import shift, median_filter, zoom
 from scipy.ndimage import gaussian_filter
 from scipy import ndimage as ndi
 from scipy.signal import fftconvolve
+from scipy.fftpack import next_fast_len
 # from skimage.measure import profile_line
 
 from astropy.modeling import models, fitting
@@ -32,6 +33,7 @@ from photutils import RectangularAperture, aperture_photometry,make_source_mask
 from wirc_drp.utils.image_utils import locationInIm, shift_and_subtract_background, fit_and_subtract_background, findTrace
 from wirc_drp.masks.wircpol_masks import *
 from wirc_drp.utils import image_utils
+from wirc_drp.utils import nbutils
 
 from astropy.stats import sigma_clipped_stats
 
@@ -140,6 +142,26 @@ def frame_rotate(array, angle, imlib='opencv', interpolation='bicubic', cxy=None
              
     return array_out
 
+def make_moffat_resid(x_grid, poly_order):
+    """
+    Residual and analytic jacobian functions for fitting a Moffat1D + Polynomial1D(poly_order) profile
+    to cross sections sampled on x_grid, for use with scipy.optimize.least_squares as
+    least_squares(resid, p0, jac = jac, args = (cross_section,)). The parameters are
+    [amplitude, x_0, gamma, alpha, c0, ..., c_poly_order], as in astropy's models.
+    The powers of x_grid for the polynomial are computed here once rather than on every evaluation.
+    Requires numba (see nbutils.no_numba).
+    """
+    x_grid = np.asarray(x_grid, dtype=np.float64)
+    vander = np.vander(x_grid, poly_order+1, increasing=True)
+
+    def resid(params, data):
+        return nbutils.moffat_poly_residual(params, x_grid, vander, data)
+
+    def jac(params, data):
+        return nbutils.moffat_poly_jacobian(params, x_grid, vander, data)
+
+    return resid, jac
+
 def fitAcrossTrace_aligned(cutout, stddev_seeing = 4, box_size = 1, plot =  False, return_residual = False, \
                             trace_angle = -45, fitfunction = 'Moffat', sum_method = 'model_sum', poly_order = 4):
     """This function iterates the cutout from bottom right to top left, makes
@@ -187,6 +209,12 @@ def fitAcrossTrace_aligned(cutout, stddev_seeing = 4, box_size = 1, plot =  Fals
     poly_results = [] #background polynomial fit
     if return_residual: #compute the background image from the fit. This is from the polynomial fit.
         residual = np.zeros(cutout_rot.shape)
+
+    #With numba, fit the Moffat profile with an analytic jacobian rather than the fitter's finite differences
+    if fitfunction == 'Moffat' and not nbutils.no_numba:
+        moffat_resid, moffat_jac = make_moffat_resid(np.arange(len(cutout_rot[lowcut:highcut])), poly_order)
+    else:
+        moffat_resid = None
     
     for i in x:
         #print(box_size*i, (box_size)*(i+1))
@@ -213,18 +241,24 @@ def fitAcrossTrace_aligned(cutout, stddev_seeing = 4, box_size = 1, plot =  Fals
 
         #cross_section = cross_section*~bad_pix.mask + smooth_cross*bad_pix.mask #fill bad pixels
 
-        if fitfunction == 'Moffat':
-            psf_moffat1d = models.Moffat1D(x_0 = np.argmax(smooth_cross), gamma = stddev_seeing, alpha = 1,  amplitude = np.max(smooth_cross))
-            model = psf_moffat1d + poly
-        elif fitfunction == 'Gaussian':
-            psf_gauss1d = models.Gaussian1D(mean = np.argmax(smooth_cross), stddev = stddev_seeing, amplitude = np.max(smooth_cross))  
-            model = psf_gauss1d + poly
-
-        f = fitting.LevMarLSQFitter()
-        #f = fitting.FittingWithOutlierRemoval(fitting.LevMarLSQFitter(), stats.sigma_clip)
-        all_res = f(model, y, cross_section)
-        res = all_res[0]
-        poly_res = all_res[1]
+        if fitfunction == 'Moffat' and moffat_resid is not None and np.all(np.isfinite(cross_section)):
+            p0 = np.r_[np.max(smooth_cross), np.argmax(smooth_cross), stddev_seeing, 1., np.zeros(poly_order+1)]
+            fit = least_squares(moffat_resid, p0, jac = moffat_jac, method = 'lm', args = (np.asarray(cross_section, dtype=np.float64),))
+            res = models.Moffat1D(amplitude = fit.x[0], x_0 = fit.x[1], gamma = fit.x[2], alpha = fit.x[3])
+            poly_res = models.Polynomial1D(poly_order, **{'c{}'.format(k): c for k, c in enumerate(fit.x[4:])})
+        else:
+            if fitfunction == 'Moffat':
+                psf_moffat1d = models.Moffat1D(x_0 = np.argmax(smooth_cross), gamma = stddev_seeing, alpha = 1,  amplitude = np.max(smooth_cross))
+                model = psf_moffat1d + poly
+            elif fitfunction == 'Gaussian':
+                psf_gauss1d = models.Gaussian1D(mean = np.argmax(smooth_cross), stddev = stddev_seeing, amplitude = np.max(smooth_cross))  
+                model = psf_gauss1d + poly
+
+            f = fitting.LevMarLSQFitter()
+            #f = fitting.FittingWithOutlierRemoval(fitting.LevMarLSQFitter(), stats.sigma_clip)
+            all_res = f(model, y, cross_section)
+            res = all_res[0]
+            poly_res = all_res[1]
         
         #plotting
         if plot:
@@ -320,6 +354,10 @@ def weighted_sum_extraction(cutout, trace, psf, ron = 12, gain = 1.2):
                 var     -- a 1D array containing estimated flux uncertainties provided read noise
 
     """
+    if not nbutils.no_numba:
+        #the same sums, compiled and with the columns spread over the cores
+        return nbutils.weighted_sum_extraction(cutout, trace, psf, ron = ron, gain = gain)
+
     ###NEW VERSION BELOW
     # width = len(cutout[0]) #we have square cutout
     # #buffer area on either ends of the trace
@@ -1185,7 +1223,7 @@ def spec_extraction(thumbnails, filter_name = 'J', plot = True, output_name = No
     return np.array(spectra), np.array(spectra_std), np.array(widths), np.array(angles), np.array(thumbnails_to_extract)  #res_spec is a dict, res_stddev and thumbnails are list
 
 
-def rough_wavelength_calibration_v1(trace, filter_name):
+def rough_wavelength_calibration_v1(trace, filter_name, plot = False):
     """
     roughWaveCal does rough wavelength calibration by comparing the extracted profile
     to the filter transmission function. It is assumed that the continuum trace 
@@ -1196,6 +1234,7 @@ def rough_wavelength_calibration_v1(trace, filter_name):
     
     Input:  trace: a 1d vector with the extracted spectral trace
             filter_name: string of filter name ('J' or 'J' for now)
+            plot: whether to plot the fitted trace over the filter transmission
     Output: a vector of wavelength corresponding to each pixel value
     """
     #First, call getFilterInfo for the transmissions curve
@@ -1242,40 +1281,53 @@ def rough_wavelength_calibration_v1(trace, filter_name):
                                                         , tol = 1e-6))
     # print(res)
     #Plotting   
-    transmission = filter_trans_int(wla)
-    transmission = np.array( [max(min(x, 0.5*np.max(transmission)), 0.05*np.max(transmission)) for x in transmission] )
-    plt.plot(wla, transmission/np.max(transmission),'b')
-    plt.plot(res.x[1] + res.x[0]*x, trace/np.max(trace),'r')
+    if plot:
+        transmission = filter_trans_int(wla)
+        transmission = np.array( [max(min(x, 0.5*np.max(transmission)), 0.05*np.max(transmission)) for x in transmission] )
+        plt.plot(wla, transmission/np.max(transmission),'b')
+        plt.plot(res.x[1] + res.x[0]*x, trace/np.max(trace),'r')
     # plt.show()    
     return res.x[1] + res.x[0]*x
    # 
 
 def rough_wavelength_calibration_v2(trace, filter_name, lowcut=0, highcut=-1):
     """
+    Rough wavelength calibration of a single 1d trace, see rough_wavelength_calibration_v2_batch
     """
+    return rough_wavelength_calibration_v2_batch(np.asarray(trace)[None,:], filter_name, lowcut=lowcut, highcut=highcut)[0]
 
-    #Make a copy
-    trace_copy = copy.deepcopy(trace)
+def rough_wavelength_calibration_v2_batch(traces, filter_name, lowcut=0, highcut=-1):
+    """
+    Rough wavelength calibration of several traces at once, by matching the steepest rise and fall of each trace
+    to those of the filter transmission function.
 
-    trace = trace[lowcut:highcut]
+    Input:  traces: a (K, N) array of K extracted spectral traces
+            filter_name: string of filter name ('J' or 'H')
+            lowcut, highcut: only the pixels [lowcut:highcut] of the traces are used to find the filter edges
+    Output: a (K, N) array with the wavelength of each pixel of each trace
+    """
+    traces = np.atleast_2d(traces)
+    cut_traces = traces[:,lowcut:highcut]
 
+    #The filter transmission only needs to be set up once for all the traces
     lb,dlb,f0,filter_trans_int, central_wl_pix = getFilterInfo(filter_name) 
-    wla = np.linspace(lb-dlb, lb+dlb, len(trace))
-    x = np.arange(len(trace))
-    # print((trace))
-    grad = np.gradient(trace) #min and max arer the steep slopes at the filter cuts
-    
+    wla = np.linspace(lb-dlb, lb+dlb, cut_traces.shape[1])
+
     trans = filter_trans_int(wla)
     grad_trans = np.gradient(trans)
     #for location of peak gradients in the transmission function, we know the wl
     wl_up = wla[np.argmax(grad_trans)]
     wl_down = wla[np.argmin(grad_trans)]
 
-    slope = (wl_down - wl_up )/(np.argmin(grad) - np.argmax(grad))
+    grad = np.gradient(cut_traces, axis = 1) #min and max arer the steep slopes at the filter cuts
+    up = np.argmax(grad, axis = 1)
+    down = np.argmin(grad, axis = 1)
+
+    slope = (wl_down - wl_up )/(down - up)
 
-    x = np.arange(len(trace_copy))
+    x = np.arange(traces.shape[1])
     
-    return slope*(x - np.argmax(grad)) + wl_up
+    return slope[:,None]*(x[None,:] - up[:,None]) + wl_up
 
 def rough_lambda_and_filter_calibration(spectra, widths, xpos, ypos, band = "J", off0 = 0.93, verbose=False, 
     plot_alignment=False, offset_method=2, tilt_angle = 45, source_compensation = False):
@@ -1497,14 +1549,23 @@ def align_set_of_traces(traces_cube, ref_trace, oversampling = 10, return_shift
     new_cube = np.zeros(traces_cube.shape)
     #upsample, nearest neighbor
     ref = zoom(ref_trace, oversampling, order = 1)
+    ref = np.nan_to_num(ref/np.nanmax(ref))
+    #upsample all the spectra, and normalize each of them to its peak
+    up_specs = np.array([zoom(j, oversampling, order = 1) for j in traces_cube])
+    trace_axes = tuple(range(1, up_specs.ndim))
+    up_specs = np.nan_to_num(up_specs/np.nanmax(up_specs, axis = trace_axes, keepdims = True))[:,::-1]
+
+    #The same full correlation as fftconvolve(ref, up_spec[::-1]) for each spectrum, but with all of them in one batched FFT
+    #and the reference only transformed once
+    corr_shape = [ref.shape[k] + up_specs.shape[k+1] - 1 for k in range(ref.ndim)]
+    fft_shape = [next_fast_len(n) for n in corr_shape]
+    ref_fft = np.fft.rfftn(ref, fft_shape)
+    corrs = np.fft.irfftn(np.fft.rfftn(up_specs, fft_shape, axes = trace_axes)*ref_fft[None], fft_shape, axes = trace_axes)
+    corrs = corrs[(slice(None),)+tuple(slice(0, n) for n in corr_shape)]
+
     #fig, (ax, ax2) = plt.subplots(2,4, figsize = (20,10))
     shifts = []
-    for i, j in enumerate(traces_cube):
-        #print(np.max(ref), np.max(j))
-        #corr = fftconvolve(ref/np.nanmax(ref), (j/np.nanmax(j))[::-1] )
-        up_spec = zoom(j, oversampling, order = 1) #upsample the spectrum
-        #corr = fftconvolve(np.nan_to_num(ref/np.nanmax(ref)), np.nan_to_num((j/np.nanmax(j))[::-1]) )#j[1,:] is the flux vector
-        corr = fftconvolve(np.nan_to_num(ref/np.nanmax(ref)), np.nan_to_num((up_spec/np.nanmax(up_spec))[::-1]) )#j[1,:] is the flux vector
+    for i, corr in enumerate(corrs):
         shift_size = np.nanargmax(corr) - len(ref) +1
         #print(shift_size)
         new_cube[i] = shift(traces_cube[i], shift_size/oversampling, order = 1) # this shifts wl, flux, and flux_error at the same time. order = 1 so linear interpolation 
@@ -1664,9 +1725,8 @@ def smooth_spectra(spectra, kernel = 'Gaussian', smooth_size = 3, rebin = False)
             out_spectra = convolve(spectra, smooth_ker)
 
         else:
-            out_spectra = np.zeros(spectra.shape)
-            for i in range(spectra.shape[0]):
-                out_spectra[i] = convolve(spectra,smooth_ker)
+            #smooth each row at once with the kernel laid along the rows
+            out_spectra = convolve(spectra, smooth_ker.array[None,:])
         #deal with rebinning        
         if rebin:
             out_spectra = out_spectra[::smooth_size]
@@ -1900,13 +1960,18 @@ def compute_polarization(trace_spectra, filter_name = 'J', plot=False, cutmin=0,
     wlUp = trace_spectra[2,0,:]
     wlUm = trace_spectra[3,0,:]
 
-    Qp = trace_spectra[0,1,:]
-    Qm = np.interp(wlQp,wlQm,trace_spectra[1,1,:])
-    Up = trace_spectra[2,1,:]
-    Um = np.interp(wlUp,wlUm,trace_spectra[3,1,:])
+    if nbutils.no_numba:
+        Qp = trace_spectra[0,1,:]
+        Qm = np.interp(wlQp,wlQm,trace_spectra[1,1,:])
+        Up = trace_spectra[2,1,:]
+        Um = np.interp(wlUp,wlUm,trace_spectra[3,1,:])
 
-    q = (Qp-Qm)/(Qp+Qm)
-    u = (Up-Um)/(Up+Um)
+        q = (Qp-Qm)/(Qp+Qm)
+        u = (Up-Um)/(Up+Um)
+    else:
+        #the same, with the interpolation and the ratio compiled into a single pass
+        q = nbutils.normalized_difference(wlQp, trace_spectra[0,1,:], wlQm, trace_spectra[1,1,:])
+        u = nbutils.normalized_difference(wlUp, trace_spectra[2,1,:], wlUm, trace_spectra[3,1,:])
 
     return wlQp, q, q*0., wlUp, u, u*0.
 
@@ -10,16 +10,45 @@ import wirc_drp.utils.image_utils as image_utils
 import wirc_drp.utils.spec_utils as spec_utils
 import wirc_drp.utils.source_utils as source_utils
 import wirc_drp.utils.calibration as calibration
+import wirc_drp.utils.nbutils as nbutils
 from wirc_drp import constants
 from wirc_drp import version # For versioning (requires gitpython 'pip install gitpython')
 from wirc_drp.masks import * ### Make sure that the wircpol/DRP/mask_design directory is in your Python Path!
+from wirc_drp.masks.wircpol_masks import cross_mask_ns_bool
 from astropy import time as ap_time, coordinates as coord, units as u
 from astropy.stats import sigma_clipped_stats
 
+#bottleneck's nanmedian is much faster than numpy's, fall back to numpy if it is not installed
+try:
+    import bottleneck as bn
+except ImportError:
+    bn = np
+
+#joblib is only used to calibrate many frames in parallel processes (wirc_data.calibrate_batch)
+try:
+    from joblib import Parallel, delayed
+    no_joblib = False
+except ImportError:
+    no_joblib = True
+
 
 
 import pdb
 import copy
+from functools import partial
+
+def _triplet_spec(prefix, value_name):
+    #(name, format, unit) of the wavelength, value and error columns of one spectrum
+    return [(prefix+' wavelength', 'D', 'nm'), (value_name, 'D', 'units?'), (value_name+' error', 'D', 'units?')]
+
+#The columns of each source's table in a saved wirc_object, in order (load_wirc_object reads them back by column number):
+#(source attribute, trace index for the 3D trace spectra arrays, specs of its three columns)
+_TRACE_SPEC = [('trace_spectra', k, _triplet_spec('trace_spectra_{}'.format(k), 'trace_spectra_{} flux'.format(k))) for k in range(4)] + \
+              [('Q', None, _triplet_spec('Q', 'Q stokes')),
+               ('U', None, _triplet_spec('U', 'U stokes')),
+               ('P', None, _triplet_spec('P', 'P')),
+               ('theta', None, _triplet_spec('theta', 'theta'))] + \
+              [('calibrated_trace_spectra', k, _triplet_spec('trace_spectra_{}_calibrated'.format(k), 'trace_spectra_{}_calibrated flux'.format(k))) for k in range(4)]
 
 class wirc_data(object):
     """
@@ -54,6 +83,9 @@ class wirc_data(object):
         ## If load_full_image is True, load the full array image. This uses a lot of memory if a lot of wric objects are loaded at once.
         ##
 
+        #Calibration frames read so far, by filename (see _load_calib)
+        self._cal_cache = {}
+
         if raw_filename is not None and wirc_object_filename is not None:
             print("Can't open both a raw file and wircpol_object, ignoring the raw file and loading the wirc_object_file ")
             print("Loading a wircpol_data object from file {}".format(wirc_object_filename))
@@ -70,7 +102,8 @@ class wirc_data(object):
             self.raw_filename = raw_filename
 
             with fits.open(raw_filename) as hdu:
-                self.full_image = hdu[0].data
+                #float32 is more than enough for the detector and halves the memory traffic of the calibration
+                self.full_image = np.asarray(hdu[0].data, dtype = np.float32)
                 self.header = hdu[0].header
 
 
@@ -99,6 +132,7 @@ class wirc_data(object):
 
             self.n_sources = 0 
             self.source_list = []
+            self.all_trace_images = None
             self.source_positions = []
             self.dark_fn = dark_fn
             self.flat_fn = flat_fn
@@ -145,6 +179,7 @@ class wirc_data(object):
             self.bkg_subbed = False
             self.n_sources = 0
             self.source_list = []
+            self.all_trace_images = None
 
 
     def calibrate(self, clean_bad_pix=True, replace_nans=True, mask_bad_pixels=False, destripe_raw = False, destripe=False, verbose=False, sub_bkg_now = True, report_median = False,
@@ -167,14 +202,20 @@ class wirc_data(object):
                                       self.full_image, n_coadds,
                                       nonlinearity_array)
 
+            #The steps below are all done in place on a native float32 image. It already is one if it was read from a raw file,
+            #in which case this doesn't copy it.
+            self.full_image = np.asarray(self.full_image, dtype = np.float32)
+            master_dark = None
+            master_flat = None
+            factor = 1.
+
             if self.dark_fn is not None:
                 #Open the master dark
-                master_dark_hdu = fits.open(self.dark_fn)
-                master_dark = master_dark_hdu[0].data
+                master_dark, master_dark_header = self._load_calib(self.dark_fn)
+                dark_exp_time = master_dark_header['EXPTIME'] * master_dark_header['COADDS']
                 dark_shape = np.shape(master_dark)
                 if verbose:
                     print(("Subtracting {} from the image".format(self.dark_fn)))
-                dark_exp_time = master_dark_hdu[0].header['EXPTIME'] * master_dark_hdu[0].header['COADDS']
                 total_exp_time = self.header["EXPTIME"]*self.header["COADDS"]
                 #Checking Dark Exposure times and scaling if need be
                 if dark_exp_time != total_exp_time:
@@ -184,8 +225,10 @@ class wirc_data(object):
                 else:
                     factor = 1.
 
-                #Subtract the dark
-                self.full_image = self.full_image-factor*master_dark
+                #Subtract the dark (with numba this is done in one pass with the flat division below)
+                if nbutils.no_numba:
+                    scratch = np.multiply(master_dark, np.float32(factor))
+                    np.subtract(self.full_image, scratch, out = self.full_image)
 
                 #Update the header
                 self.header['HISTORY'] = "Subtracting {} from each flat file".format(self.dark_fn)
@@ -196,13 +239,13 @@ class wirc_data(object):
 
             if self.flat_fn is not None:
                 #Open the master flat
-                master_flat_hdu = fits.open(self.flat_fn)
-                master_flat = master_flat_hdu[0].data
+                master_flat = self._load_calib(self.flat_fn)[0]
                 if verbose:
                     print(("Dividing the image by {}".format(self.flat_fn)))
 
                 #Divide the flat
-                self.full_image = self.full_image/master_flat
+                if nbutils.no_numba:
+                    np.divide(self.full_image, master_flat, out = self.full_image)
 
                 #Update the header
                 self.header['HISTORY'] = "Dividing each file by {}".format(self.flat_fn)
@@ -211,6 +254,10 @@ class wirc_data(object):
             else:
                 print("No flat filename found, continuing without divinding by a falt")
 
+            #Subtract the dark and divide by the flat in a single compiled pass
+            if not nbutils.no_numba and (master_dark is not None or master_flat is not None):
+                nbutils.dark_flat_correct(self.full_image, master_dark, factor, master_flat)
+
             if report_median:
                 mean, med, std = sigma_clipped_stats(self.full_image.flatten())
 
@@ -225,15 +272,14 @@ class wirc_data(object):
             hot_pixel_map = np.zeros(self.full_image.shape) #start with zeros, if provided then change the values
             if self.bp_fn is not None:
                 #Open the bad pixel map
-                bp_map_hdu = fits.open(self.bp_fn)
-                bad_pixel_map = bp_map_hdu[0].data
+                bad_pixel_map = self._load_calib(self.bp_fn)[0]
                 bad_pixel_map_bool = np.array(bad_pixel_map, dtype=bool)
                 if verbose:
                     print(("Using bad pixel map {}".format(self.bp_fn)))
 
                 #if hot pixel map is also given
                 if self.hp_fn is not None:
-                    hot_pixel_map = fits.open(self.hp_fn)[0].data
+                    hot_pixel_map = self._load_calib(self.hp_fn)[0]
                     bad_pixel_map_bool = np.logical_or(bad_pixel_map_bool, hot_pixel_map.astype(bool)) #combine two maps
 
                 if clean_bad_pix:
@@ -255,7 +301,7 @@ class wirc_data(object):
 
                 #Mask the bad pixels if the flag is set
                 if mask_bad_pixels:
-                    redux = self.full_image*~bad_pixel_map_bool
+                    redux = np.multiply(self.full_image, ~bad_pixel_map_bool, out = self.full_image)
 
                     #Update the header
                     if self.hp_fn is not None:
@@ -277,8 +323,8 @@ class wirc_data(object):
 
             #Replace the nans if the flag is set.
             if replace_nans:
-                nanmask = np.isnan(self.full_image) #nan = True, just in case this is useful
-                self.full_image = np.nan_to_num(self.full_image)
+                #in place, the image is already our own float32 copy
+                self.full_image = np.nan_to_num(self.full_image, copy = False)
 
 
             #Turn on the calibrated flag
@@ -293,7 +339,39 @@ class wirc_data(object):
         else:
             print("Data already calibrated")
 
+    @classmethod
+    def calibrate_batch(cls, wirc_objects, n_jobs = -1, **kwargs):
+        '''
+        Calibrate a list of wirc_data objects, one frame per process. The keyword arguments are passed on to calibrate().
+        Each frame is calibrated single threaded, since a 2048x2048 frame is too small to be worth splitting across cores.
+
+        n_jobs: number of processes (-1 = all cores, 1 = serial). Needs joblib.
+
+        Returns the list of calibrated objects. When they were calibrated in other processes these are copies,
+        so use the returned list rather than the one passed in.
+        '''
+        if no_joblib or n_jobs == 1:
+            for wirc_object in wirc_objects:
+                wirc_object.calibrate(**kwargs)
+            return list(wirc_objects)
+
+        return Parallel(n_jobs = n_jobs, backend = 'loky')(delayed(_calibrate_one)(wirc_object, kwargs) for wirc_object in wirc_objects)
+
     
+    def _load_calib(self, filename):
+        """
+        Read the calibration frame in filename as a read-only native float32 array and return it with its header.
+        The frames are kept by filename, so calibrate() and generate_and_subtract_bkg() read each one only once.
+        """
+        if filename not in self._cal_cache:
+            with fits.open(filename) as hdulist:
+                data = np.array(hdulist[0].data, dtype = np.float32)
+                header = hdulist[0].header.copy()
+            data.flags.writeable = False
+            self._cal_cache[filename] = (data, header)
+
+        return self._cal_cache[filename]
+
     def generate_and_subtract_bkg(self, method='shift_and_subtract', bkg_fn=None, ref_lib=None, num_PCA_modes=None, bkg_by_quadrants=False, destripe=False,
         shift_dir='diagonal', bkg_sub_shift_size = 31, filter_bkg_size=None):
         """
@@ -338,7 +416,7 @@ class wirc_data(object):
             if self.ref_lib is not None:
                 bkg_frames = []
                 for i in range(len(self.ref_lib)):
-                    bkg_frames.append(fits.getdata(self.ref_lib[i]))
+                    bkg_frames.append(np.asarray(fits.getdata(self.ref_lib[i]), dtype = np.float32))
             
                 print('Subtracting background using median reference frame.')
                 self.bkg_image = np.nanmedian(bkg_frames, axis=0)
@@ -350,12 +428,13 @@ class wirc_data(object):
         elif method == 'scaled_bkg':
             if self.bkg_fn is not None: 
                 print('Subtracting background using scaled background frame.')
-                background_hdu = fits.open(self.bkg_fn)
-                background = background_hdu[0].data
-                bkg_exp_time = background_hdu[0].header["EXPTIME"]*background_hdu[0].header["COADDS"]
+                background, background_header = self._load_calib(self.bkg_fn)
+                #A copy, since the dark and flat are taken out of it in place
+                background = np.array(background)
+                bkg_exp_time = background_header["EXPTIME"]*background_header["COADDS"]
                 #Check if background is already reduced
                 try:
-                    bkg_reduced = background_hdu[0].header["CALBRTED"]
+                    bkg_reduced = background_header["CALBRTED"]
                 except KeyError as e:
                     bkg_reduced = False
 
@@ -363,11 +442,10 @@ class wirc_data(object):
                     #Checking Dark Exposure times and scaling if need be
                     if self.dark_fn is not None:
                         #Open the master dark
-                        master_dark_hdu = fits.open(self.dark_fn)
-                        master_dark = master_dark_hdu[0].data
+                        master_dark, master_dark_header = self._load_calib(self.dark_fn)
+                        dark_exp_time = master_dark_header['EXPTIME'] * master_dark_header['COADDS']
                         if verbose:
                             print(("Subtracting {} from the background image".format(self.dark_fn)))
-                        dark_exp_time = master_dark_hdu[0].header['EXPTIME'] * master_dark_hdu[0].header['COADDS']
                         if dark_exp_time != bkg_exp_time:
                             if verbose:
                                 print("The master dark file doesn't have the same exposure time as the background image. We'll scale the dark for now, but this isn't ideal")
@@ -377,21 +455,22 @@ class wirc_data(object):
                         if verbose:
                             print("Subtracting background frame {} from all science files".format(self.bkg_fn))
 
-                        background = background - bk_factor*master_dark
+                        background -= np.float32(bk_factor)*master_dark
 
                     if self.flat_fn is not None:
-                        master_flat = fits.getdata(self.flat_fn)
-                        background = background/master_flat
+                        master_flat = self._load_calib(self.flat_fn)[0]
+                        background /= master_flat
                 else: #if the background is already reduced
                     pass #do nothing, it's already good!
                 self.bkg_image = background
 
                 ### If this flag is set, you estimate the scaling by the median of each quadrant, not the whole image. 
                 if bkg_by_quadrants:
-                    scale_bkg1 = np.nanmedian(self.full_image[:1063,:1027])/np.nanmedian(background[:1063,:1027])
-                    scale_bkg2 = np.nanmedian(self.full_image[:1063,1027:])/np.nanmedian(background[:1063,1027:])
-                    scale_bkg3 = np.nanmedian(self.full_image[1063:,:1027])/np.nanmedian(background[1063:,:1027])
-                    scale_bkg4 = np.nanmedian(self.full_image[1063:,1027:])/np.nanmedian(background[1063:,1027:])
+                    scale_bkg1 = bn.nanmedian(self.full_image[:1063,:1027])/bn.nanmedian(background[:1063,:1027])
+                    scale_bkg2 = bn.nanmedian(self.full_image[:1063,1027:])/bn.nanmedian(background[:1063,1027:])
+                    scale_bkg3 = bn.nanmedian(self.full_image[1063:,:1027])/bn.nanmedian(background[1063:,:1027])
+                    scale_bkg4 = bn.nanmedian(self.full_image[1063:,1027:])/bn.nanmedian(background[1063:,1027:])
+                    self.scale_bkg = [scale_bkg1, scale_bkg2, scale_bkg3, scale_bkg4]
 
                     self.full_image[:1063,:1027] = self.full_image[:1063,:1027] - scale_bkg1*background[:1063,:1027]
                     self.full_image[:1063,1027:] = self.full_image[:1063,1027:] - scale_bkg2*background[:1063,1027:]
@@ -399,7 +478,8 @@ class wirc_data(object):
                     self.full_image[1063:,1027:] = self.full_image[1063:,1027:] - scale_bkg4*background[1063:,1027:]
 
                 else:
-                    scale_bkg = np.nanmedian(self.full_image)/np.nanmedian(background)
+                    scale_bkg = bn.nanmedian(self.full_image)/bn.nanmedian(background)
+                    self.scale_bkg = scale_bkg
 
                     #Subtract the background
                     self.full_image = self.full_image - scale_bkg*background
@@ -427,94 +507,48 @@ class wirc_data(object):
 
 
 
-    def make_triplet_table(self, array_in, c1list, c2list, c3list):
-        #convert array to fits columns and then fits tables. returns a fits table with 3 columns.
-
-        #developed to be called by save_wirc_object (the previously listed function)
-
-        #first verifies if array_in has information (not None)
-        length=[] #initiates list
-        if array_in is not None:
-                #print ("array_in is not None")
-
-                #verifies/determines if array_in.ndim is 2 or 3.
-                #if 2
-                if array_in.ndim ==2:
-                    #print("array_in.ndim ==2");
-
-                    #defines columns, including data
-                    c1 = fits.Column(name=c1list[0],format=c1list[1],unit=c1list[2], array=array_in[0,:])
-                    c2 = fits.Column(name=c2list[0],format=c2list[1],unit=c2list[2], array=array_in[1,:])
-                    c3 = fits.Column(name=c3list[0],format=c3list[1],unit=c3list[2], array=array_in[2,:])
-
-                #if 3
-                elif array_in.ndim ==3:
-                    #print("array_in.ndim ==3");
-                    #finds the extra index from the name (0th item in list, 14th character in string, converted to int)
-                    #print(c1list[0])
-                    ex_i=int(c1list[0][14])
-
-                    #defines columns, including data
-                    c1 = fits.Column(name=c1list[0],format=c1list[1],unit=c1list[2], array=array_in[ex_i,0,:])
-                    c2 = fits.Column(name=c2list[0],format=c2list[1],unit=c2list[2], array=array_in[ex_i,1,:])
-                    c3 = fits.Column(name=c3list[0],format=c3list[1],unit=c3list[2], array=array_in[ex_i,2,:])
-
-                #if array_in is neither ndim, raises warning to user, and leaves columns blank to allow rest of program to run
-                else:
-                    #print ("Warning: While trying to convert array_in into a 3 column table, array_in.ndim != 2 or 3")
-
-                    #defines columns, not including data
-                    c1 = fits.Column(name=c1list[0],format=c1list[1],unit=c1list[2], array=np.array([]))
-                    c2 = fits.Column(name=c2list[0],format=c2list[1],unit=c2list[2], array=np.array([]))
-                    c3 = fits.Column(name=c3list[0],format=c3list[1],unit=c3list[2], array=np.array([]))
-
-
-
-
-        #if array_in is None, initiates blank columns
-        else :
-                #print ("array_in == None")
+    def _make_source_columns(self, source):
+        """
+        Convert the spectra of a source to the fits columns of its table in save_wirc_object:
+        three columns (wavelength, value, error) for each of the four trace spectra, Q, U, P, theta,
+        and the four calibrated trace spectra, in that order (load_wirc_object reads them back by column number).
 
-                #defines columns, not including data
-                c1 = fits.Column(name=c1list[0],format=c1list[1],unit=c1list[2], array=np.array([]))
-                c2 = fits.Column(name=c2list[0],format=c2list[1],unit=c2list[2], array=np.array([]))
-                c3 = fits.Column(name=c3list[0],format=c3list[1],unit=c3list[2], array=np.array([]))
+        Returns the list of 36 fits.Columns and a list of the length of the data in each column.
+        Spectra that haven't been computed give empty columns.
+        """
+        columns = []
+        lengths = []
+        for attribute, index, specs in _TRACE_SPEC:
+            array_in = getattr(source, attribute)
+
+            if array_in is not None and array_in.ndim == 2:
+                rows = array_in
+            elif array_in is not None and array_in.ndim == 3 and index is not None:
+                rows = array_in[index]
+            else:
+                #not computed yet (or an unexpected shape), leave the columns blank so the rest of the save still works
+                rows = [np.array([])]*3
 
-        length=[len(c1.array),len(c2.array),len(c2.array)] #defines length list as the length of the arrays given to each column
+            columns += [fits.Column(name=name, format=fmt, unit=unit, array=row) for (name, fmt, unit), row in zip(specs, rows)]
+            lengths += [len(row) for row in rows]
 
-        #returns table equivalent of array_in and corresponding c<#>lists, also returns length list
-        return fits.BinTableHDU.from_columns(fits.ColDefs([c1,c2,c3])),length
+        return columns, lengths
 
     def table_columns_to_array(self,table_in,prihdr,cil):
-        list3columns = [] #initiates a list of arrays representing the columns
-
-        if len(cil) ==3: #if there are 3 columns
-
-            #appends the padding-removed arrays (from the columns) to the list3columns
-            for j in range(len(cil)):
-                list3columns.append(table_in.field(cil[j])[0:prihdr['TLENG'+str(cil[j]+1)]])
-
-            #stacks the list together to make 2D output array
-            array_out=np.stack((list3columns[0],list3columns[1],list3columns[2]))
-
-        elif len(cil) ==12: #if there are 12 columns
-
-            for j in range(len(cil)):
-                list3columns.append(table_in.field(cil[j])[0:prihdr['TLENG'+str(cil[j]+1)]])
-
-            #stacks portion of list together to form 4 2D arrays
-            array_a=np.stack((list3columns[0],list3columns[1],list3columns[2]))
-            array_b=np.stack((list3columns[3],list3columns[4],list3columns[5]))
-            array_c=np.stack((list3columns[6],list3columns[7],list3columns[8]))
-            array_d=np.stack((list3columns[9],list3columns[10],list3columns[11]))
+        #Stacks the columns in cil (3 or 12 of them), with the padding removed, into a 2D (3, n) array
+        #or, for 12 columns, a 3D (4, 3, n) array of the four traces
+        if len(cil) not in (3, 12):
+            print ("Warning: column list improper number of columns")
+            return np.array([])#None
 
-            #stacks the 2D arrays to form a 3D output array
-            array_out=np.stack((array_a,array_b,array_c,array_d),axis=0)
+        #the TLENG header keywords hold the unpadded length of each column
+        names = table_in.dtype.names
+        columns = [table_in[names[c]][0:prihdr['TLENG'+str(c+1)]] for c in cil]
+        array_out = np.stack(columns)
 
+        if len(cil) == 12:
+            array_out = array_out.reshape(4, 3, -1)
 
-        else:
-            print ("Warning: column list improper number of columns")
-            array_out = np.array([])#None
         return array_out
 
 
@@ -533,18 +567,16 @@ class wirc_data(object):
         #TODO: Update the header keywords below to include a keyword description like PS_VERS above
 
         #These may not always be set by other function
-        self.header["NSOURCES"] = self.n_sources
-        self.header["DARK_FN"] = self.dark_fn
-        self.header["FLAT_FN"] = self.flat_fn
-        self.header["BP_FN"] = self.bp_fn
-        self.header["BKG_FN"] = self.bkg_fn
-
-        #Have the data been calibrated/background subtracted?
-        self.header["CALBRTED"] = self.calibrated
-        self.header["BKG_SUBD"] = self.bkg_subbed
-
-        #add in time stamp
-        self.header["BJD"]=self.bjd
+        self.header.update({"NSOURCES": self.n_sources,
+                            "DARK_FN": self.dark_fn,
+                            "FLAT_FN": self.flat_fn,
+                            "BP_FN": self.bp_fn,
+                            "BKG_FN": self.bkg_fn,
+                            #Have the data been calibrated/background subtracted?
+                            "CALBRTED": self.calibrated,
+                            "BKG_SUBD": self.bkg_subbed,
+                            #add in time stamp
+                            "BJD": self.bjd})
 
         #Was it marked bad?
         if self.bad_flag:
@@ -553,12 +585,18 @@ class wirc_data(object):
         else:
             self.header['BAD_FLAG'] = "False"
 
-        if save_full_image:
-            hdu = fits.PrimaryHDU(self.full_image)
+        #float32 is plenty for the image and halves the file size compared to float64
+        if save_full_image and self.full_image is not None:
+            hdu = fits.PrimaryHDU(np.asarray(self.full_image, dtype=np.float32))
         else:
             hdu = fits.PrimaryHDU([])
 
-        hdu.header = self.header
+        #A copy, so that the keys dropped below stay in this object's header
+        hdu.header = self.header.copy()
+        #The header comes from the raw frame, whose integer data is scaled. The saved image isn't.
+        for key in ['BZERO', 'BSCALE']:
+            if key in hdu.header:
+                del hdu.header[key]
 
         hdulist = fits.HDUList([hdu])
 
@@ -568,6 +606,13 @@ class wirc_data(object):
         else:
             hdulist.append(fits.ImageHDU([]))
 
+        #Write the full image and the DQ frame first, then append the sources one at a time
+        #so that only one source's HDUs are held in memory at once
+        if verbose:
+            print("Saving a wirc_object to {}".format(wirc_object_filename));
+        hdulist.writeto(wirc_object_filename, overwrite=overwrite, output_verify='ignore', checksum=False)
+        del hdulist, hdu
+
         #Now for each source, create a ImageHDU, this works even if the cutouts haven't been extracted
         #Now for each source, create a TableHDU
 
@@ -577,32 +622,32 @@ class wirc_data(object):
             #Create an ImageHDU for each of the sources
             # source_hdu = fits.ImageHDU(self.source_list[i].trace_images)
             if self.source_list[i].trace_images_extracted is not None and self.source_list[i].trace_images_DQ is not None:
-                source_hdu = fits.PrimaryHDU(np.concatenate([self.source_list[i].trace_images, self.source_list[i].trace_images_DQ,
+                source_hdu = fits.ImageHDU(np.concatenate([self.source_list[i].trace_images, self.source_list[i].trace_images_DQ,
                                                         self.source_list[i].trace_images_extracted]))
             elif self.source_list[i].trace_images_DQ is not None:
-                source_hdu = fits.PrimaryHDU(np.concatenate([self.source_list[i].trace_images,
+                source_hdu = fits.ImageHDU(np.concatenate([self.source_list[i].trace_images,
                                                         self.source_list[i].trace_images_DQ]))
             else:
-                source_hdu = fits.PrimaryHDU(self.source_list[i].trace_images)
+                source_hdu = fits.ImageHDU(self.source_list[i].trace_images)
 
             #Put in the source info
-            source_hdu.header["XPOS"] = self.source_list[i].pos[0]
-            source_hdu.header["YPOS"] = self.source_list[i].pos[1]
+            source = self.source_list[i]
+            source_info = {"XPOS": source.pos[0], "YPOS": source.pos[1]}
 
             #only write position errors if they exist.
-            if len(self.source_list[i].pos)>2:
-                source_hdu.header["XPOS_ERR"] = self.source_list[i].pos[2]
-                source_hdu.header['YPOS_ERR'] = self.source_list[i].pos[3]
+            if len(source.pos)>2:
+                source_info["XPOS_ERR"] = source.pos[2]
+                source_info["YPOS_ERR"] = source.pos[3]
 
-
-
-            source_hdu.header["SLIT_LOC"] = self.source_list[i].slit_pos
+            source_info["SLIT_LOC"] = source.slit_pos
 
             #Data reduction status headers for each source
-            source_hdu.header["WL_CBRTD"] = (self.source_list[i].lambda_calibrated,"Wavelength Calibrated? status")
-            source_hdu.header["POL_CMPD"] = (self.source_list[i].polarization_computed,"Polarization Computed? status")
-            source_hdu.header["SPC_XTRD"] = (self.source_list[i].spectra_extracted,"Spectra Extracted? status")
-            source_hdu.header["THMB_CUT"] = (self.source_list[i].thumbnails_cut_out,"Thumbnails cut out? status")
+            source_info["WL_CBRTD"] = (source.lambda_calibrated,"Wavelength Calibrated? status")
+            source_info["POL_CMPD"] = (source.polarization_computed,"Polarization Computed? status")
+            source_info["SPC_XTRD"] = (source.spectra_extracted,"Spectra Extracted? status")
+            source_info["THMB_CUT"] = (source.thumbnails_cut_out,"Thumbnails cut out? status")
+
+            source_hdu.header.update(source_info)
 
             #widths and angles of the traces
             if self.source_list[i].spectra_widths is not None:
@@ -611,63 +656,25 @@ class wirc_data(object):
                 source_hdu.header["ANGLES"]=  (np.array2string(self.source_list[i].spectra_angles), "Angles of spectra in unrotated image")
 
 
-            #Append it to the hdu list
-            hdulist.append(source_hdu)
+            #Append it to the file
+            fits.append(wirc_object_filename, source_hdu.data, source_hdu.header, verify=False)
 
 
             #TODO: Add a fits table extension (or a series of them) to contain the spectra
             #Create a TableHDU for each of the sources
 
-            #The source_list attributes, trace_spectra(four separate trace spectra), Q, U, P, theta, are converted into tables of three columns each. Also returns length lists of each array
-            t_ts_0,l0=self.make_triplet_table(self.source_list[i].trace_spectra, ['trace_spectra_0 wavelength','D','nm'], ['trace_spectra_0 flux','D','units?'], ['trace_spectra_0 flux error','D','units?'])#trace spectra 0
-            t_ts_1,l1=self.make_triplet_table(self.source_list[i].trace_spectra, ['trace_spectra_1 wavelength','D','nm'], ['trace_spectra_1 flux','D','units?'], ['trace_spectra_1 flux error','D','units?'])#trace spectra 1
-            t_ts_2,l2=self.make_triplet_table(self.source_list[i].trace_spectra, ['trace_spectra_2 wavelength','D','nm'], ['trace_spectra_2 flux','D','units?'], ['trace_spectra_2 flux error','D','units?'])#trace spectra 2
-            t_ts_3,l3=self.make_triplet_table(self.source_list[i].trace_spectra, ['trace_spectra_3 wavelength','D','nm'], ['trace_spectra_3 flux','D','units?'], ['trace_spectra_3 flux error','D','units?'])#trace spectra 3
-
-            #if calibrated, add the calibrated trace
-
-            t_ts_0_cal,l0_cal=self.make_triplet_table(self.source_list[i].calibrated_trace_spectra, ['trace_spectra_0_calibrated wavelength','D','nm'], ['trace_spectra_0_calibrated flux','D','units?'], ['trace_spectra_0_calibrated flux error','D','units?'])#trace spectra 0
-            t_ts_1_cal,l1_cal=self.make_triplet_table(self.source_list[i].calibrated_trace_spectra, ['trace_spectra_1_calibrated wavelength','D','nm'], ['trace_spectra_1_calibrated flux','D','units?'], ['trace_spectra_1_calibrated flux error','D','units?'])#trace spectra 1
-            t_ts_2_cal,l2_cal=self.make_triplet_table(self.source_list[i].calibrated_trace_spectra, ['trace_spectra_2_calibrated wavelength','D','nm'], ['trace_spectra_2_calibrated flux','D','units?'], ['trace_spectra_2_calibrated flux error','D','units?'])#trace spectra 2
-            t_ts_3_cal,l3_cal=self.make_triplet_table(self.source_list[i].calibrated_trace_spectra, ['trace_spectra_3_calibrated wavelength','D','nm'], ['trace_spectra_3_calibrated flux','D','units?'], ['trace_spectra_3_calibrated flux error','D','units?'])#trace spectra 3
-
-
-            t_Q,lQ=self.make_triplet_table(self.source_list[i].Q, ['Q wavelength','D','nm'], ['Q stokes','D','units?'], ['Q stokes error','D','units?'])               #Q
-
-            t_U,lU=self.make_triplet_table(self.source_list[i].U, ['U wavelength','D','nm'], ['U stokes','D','units?'], ['U stokes error','D','units?'])               #U
-
-            t_P,lP=self.make_triplet_table(self.source_list[i].P, ['P wavelength','D','nm'], ['P','D','units?'], ['P error','D','units?'])               #P
-
-            t_theta,ltheta=self.make_triplet_table(self.source_list[i].theta, ['theta wavelength','D','nm'], ['theta','D','units?'], ['theta error','D','units?'])       #theta
-            #tables of 3 columns each have been made
-
-
-
-            #big table gets made
-            #the .columns of each three-column-table are added up to form column_list
-            column_list= t_ts_0.columns + t_ts_1.columns + t_ts_2.columns + t_ts_3.columns +  t_Q.columns + t_U.columns  + t_P.columns + t_theta.columns + t_ts_0_cal.columns+t_ts_1_cal.columns+t_ts_2_cal.columns+t_ts_3_cal.columns
-
-            #the column_list becomes a quite large fits table called source_tbl_hdu
-            source_tbl_hdu=fits.BinTableHDU.from_columns(column_list)
-
-
-
-            #Append it to the hdu list
-            hdulist.append(source_tbl_hdu)
-
-            length_list=l0+l1+l2+l3+lQ+lU+lP+ltheta+l0_cal+l1_cal+l2_cal+l3_cal  #making a list of the lengths of columns
-            #print ('Ending Iteration #',i);
+            #The source_list attributes, trace_spectra(four separate trace spectra), Q, U, P, theta, calibrated_trace_spectra
+            #are converted into three columns each, all of which go into one big table. Also returns the lengths of the columns
+            column_list, length_list = self._make_source_columns(self.source_list[i])
+            source_tbl_hdu = fits.BinTableHDU.from_columns(column_list)
 
             #Creates a header keyword, value, and comment.
             #The value designates the length the array that would correspond to the column.
             for k in range(len(length_list)):
-                #defines keyword string
-                header_keyword="TLENG"+str(k+1)
-                #defines comment string
-                header_comment="Length of "+hdulist[(2*i)+3].data.names[k]
+                source_tbl_hdu.header["TLENG"+str(k+1)] = (length_list[k], "Length of "+column_list[k].name)
 
-
-                hdulist[(2*i)+3].header[header_keyword]=(length_list[k],header_comment) #defines the keyword with value and comment
+            #Append it to the file
+            fits.append(wirc_object_filename, source_tbl_hdu.data, source_tbl_hdu.header, verify=False)
 
         #For loop ended
         #print ('No more iterations');
@@ -675,14 +682,6 @@ class wirc_data(object):
 
 
 
-        #Saving a wirc_object (hdulist)
-        if verbose:
-            print("Saving a wirc_object to {}".format(wirc_object_filename));
-        hdulist.writeto(wirc_object_filename, overwrite=overwrite)
-
-
-
-
 
 
     def load_wirc_object(self, wirc_object_filename, load_full_image = True, verbose=True):
@@ -697,7 +696,7 @@ class wirc_data(object):
         #----#(2*i)+1 is a conversion from the index, i, of the source in source_list to the index of the source in hdulist
         #----#(2*i)+2 is a conversion from the index, i, of the source in source_list to the index of the source's corresponding table in hdulist
 
-        #Open the fits file
+        #Open the fits file. astropy only reads an HDU when it is indexed, so the full image isn't read unless load_full_image is set
         with fits.open(wirc_object_filename) as hdulist:
 
             #Read in the full image and the primary header
@@ -764,16 +763,17 @@ class wirc_data(object):
 
             for i in range(self.n_sources):
                 #print ("starting iteration #",i)
-                #Extract the source info from the header
-                xpos        = copy.deepcopy(hdulist[(2*i)+2].header["XPOS"])
-                ypos        = copy.deepcopy(hdulist[(2*i)+2].header["YPOS"])
-                slit_loc    = copy.deepcopy(hdulist[(2*i)+2].header["SLIT_LOC"])
+                #Extract the source info from the header, read into a plain dict once
+                source_header = dict(hdulist[(2*i)+2].header)
+                xpos        = source_header["XPOS"]
+                ypos        = source_header["YPOS"]
+                slit_loc    = source_header["SLIT_LOC"]
 
                 #if they are there)
 
                 try:
-                    xpos_err = copy.deepcopy(hdulist[(2*i)+2].header["XPOS_ERR"])
-                    ypos_err = copy.deepcopy(hdulist[(2*i)+2].header["YPOS_ERR"])
+                    xpos_err = source_header["XPOS_ERR"]
+                    ypos_err = source_header["YPOS_ERR"]
                     new_source = wircpol_source([xpos,ypos,xpos_err,ypos_err],slit_loc, i)
 
                 except KeyError:
@@ -785,10 +785,11 @@ class wirc_data(object):
                 new_source.trace_images_extracted   = copy.deepcopy(hdulist[(2*i)+2].data[8:] )#last 4 images are from which extraction is done.
 
                 #finds the table data of the TableHDU corresponding to the i'th source
-                big_table = copy.deepcopy(hdulist[(2*i)+3].data )
+                #read into a plain structured array in one go, its columns are then simple views rather than FITS_rec field lookups
+                big_table = np.array(hdulist[(2*i)+3].data)
 
                 #finds the header of the TableHDU corresponding to the i'th source
-                prihdr = copy.deepcopy(hdulist[(2*i)+3].header )
+                prihdr = dict(hdulist[(2*i)+3].header)
 
 
                 #for the column number, refers to the variable "column_list" in save_wirc_object. each variable has 4 columns for 4 traces
@@ -814,14 +815,14 @@ class wirc_data(object):
                 new_source.theta = self.table_columns_to_array(big_table,prihdr,[21,22,23])
 
                 #adjusting source header statuses
-                new_source.lambda_calibrated        = copy.deepcopy(hdulist[(2*i)+2].header["WL_CBRTD"])#source attribute, later applied to header["WL_CBRTD"]
-                new_source.polarization_computed    = copy.deepcopy(hdulist[(2*i)+2].header["POL_CMPD"]) #source attribute, later applied to header["POL_CMPD"]
-                new_source.spectra_extracted        = copy.deepcopy(hdulist[(2*i)+2].header["SPC_XTRD"]) #source attribute, later applied to header["SPC_XTRD"]
-                new_source.thumbnails_cut_out       = copy.deepcopy(hdulist[(2*i)+2].header["THMB_CUT"]) #source attribute, later applied to header["THMB_CUT"]
+                new_source.lambda_calibrated        = source_header["WL_CBRTD"]#source attribute, later applied to header["WL_CBRTD"]
+                new_source.polarization_computed    = source_header["POL_CMPD"] #source attribute, later applied to header["POL_CMPD"]
+                new_source.spectra_extracted        = source_header["SPC_XTRD"] #source attribute, later applied to header["SPC_XTRD"]
+                new_source.thumbnails_cut_out       = source_header["THMB_CUT"] #source attribute, later applied to header["THMB_CUT"]
 
                 try:
-                    new_source.spectra_widths = np.fromstring(hdulist[(2*i)+2].header["WIDTHS"][1:-1], sep = ' ')
-                    new_source.spectra_angles = np.fromstring(hdulist[(2*i)+2].header["ANGLES"][1:-1], sep = ' ')
+                    new_source.spectra_widths = np.fromstring(source_header["WIDTHS"][1:-1], sep = ' ')
+                    new_source.spectra_angles = np.fromstring(source_header["ANGLES"][1:-1], sep = ' ')
                 except KeyError:
                     None
 
@@ -830,6 +831,8 @@ class wirc_data(object):
                 #Append it to the source_list
                 self.source_list.append(new_source)
             hdulist.close()
+
+            self.gather_trace_images()
             #print ("ending iteration #",i)
 
 
@@ -940,18 +943,17 @@ class wirc_data(object):
             direct_image = fits.open(image_fn)[0].data
 
             #Get the focal plane mask.
-            mask = cross_mask_ns.astype('bool') #What does our mask look like?
+            mask = cross_mask_ns_bool #What does our mask look like?
 
             #Find the sources
             locations = image_utils.find_sources_in_direct_image(direct_image, mask, threshold_sigma = threshold_sigma, guess_seeing = guess_seeing, plot = plot)
 
-            #How many sources are there?
-            self.n_sources = np.shape(locations[0,:])[0]+1
+            #How many sources are there? locations has one [[y,x], slit_pos] row per source
+            self.n_sources = len(locations)
             self.header['NSOURCES'] = self.n_sources
 
-            #Append all the new objects
-            for source in range(self.n_sources):
-                self.source_list.append(wircpol_source(locations[source, 0], locations[source,1],source))
+            #Make all the new objects
+            self.source_list = [wircpol_source(locations[source, 0], locations[source,1],source) for source in range(self.n_sources)]
 
             # else:
             #     print("No direct image filename given. For now we can only find sources automatically in a direct image, so we'll assume that there's a source in the middle slit. If you wish you can add other sources as follows: \n\n > wirc_data.source_list.append(wircpol_source([y,x],slit_pos,wirc_data.n_sources+1) \
@@ -1038,9 +1040,44 @@ class wirc_data(object):
         """
         Get thumbnail cutouts for the spectra of for each source in the image.
         """
+        if self.n_sources == 0:
+            return
+
+        #Cut out the thumbnails of all the sources with one call, in the [[y,x], slit_pos] format of cutout_trace_thumbnails
+        locations = np.empty((self.n_sources, 2), dtype = object)
+        for source in range(self.n_sources):
+            locations[source,0] = [int(self.source_list[source].pos[0]), int(self.source_list[source].pos[1])]
+            locations[source,1] = self.source_list[source].slit_pos
+
+        thumbnails = image_utils.cutout_trace_thumbnails(self.full_image, locations, flip = False, filter_name = self.filter_name, sub_bar = True)
+        try:
+            thumbnails_DQ = image_utils.cutout_trace_thumbnails(self.DQ_image, locations, flip = False, filter_name = self.filter_name, sub_bar = False)
+        except:
+            #get_cutouts deals with a missing DQ image
+            thumbnails_DQ = [None]*self.n_sources
 
         for source in range(self.n_sources):
-            self.source_list[source].get_cutouts(self.full_image, self.DQ_image, filter_name = self.filter_name, sub_bar = True)
+            self.source_list[source].get_cutouts(self.full_image, self.DQ_image, filter_name = self.filter_name, sub_bar = True,
+                                                trace_images = thumbnails[source], trace_images_DQ = thumbnails_DQ[source])
+
+        self.gather_trace_images()
+
+    def gather_trace_images(self):
+        """
+        Stack the trace_images of all the sources into one contiguous (n_sources, 4, N, N) array, self.all_trace_images,
+        and make each source's trace_images a view into it, so operations on all the sources' thumbnails can be done at once.
+        If the sources' thumbnails are missing or have different shapes self.all_trace_images is None.
+        """
+        self.all_trace_images = None
+
+        trace_images = [source.trace_images for source in self.source_list]
+        if len(trace_images) == 0 or any(np.ndim(images) != 3 for images in trace_images) \
+                or len(set(np.shape(images) for images in trace_images)) != 1:
+            return
+
+        self.all_trace_images = np.stack(trace_images)
+        for i, source in enumerate(self.source_list):
+            source.trace_images = self.all_trace_images[i]
 
     def mark_bad(self, reason = "A good reason"):
         self.bad_flag = True
@@ -1048,6 +1085,21 @@ class wirc_data(object):
 
 
 
+def _thumbnail_locations(locs, slit_pos):
+    #A single source's [[y,x], slit_pos] as the (1, 2) object array cutout_trace_thumbnails expects.
+    #np.expand_dims([locs, slit_pos]) would be a ragged array, which numpy no longer builds.
+    locations = np.empty((1, 2), dtype = object)
+    locations[0,0] = locs
+    locations[0,1] = slit_pos
+    return locations
+
+def _calibrate_one(wirc_object, kwargs):
+    #Run in a worker process by wirc_data.calibrate_batch. The frames are already spread over the cores, so keep numba to one thread.
+    nbutils.set_num_threads(1)
+    wirc_object.calibrate(**kwargs)
+    return wirc_object
+
+
 class wircpol_source(object):
     """
     A point-source in a wircpol_data image
@@ -1060,6 +1112,7 @@ class wircpol_source(object):
     Attributes:
         trace_images - An array of size [4,N,N], where n is the width of the box, and there is one image for each trace
         trace_spectra - An array of size [4,3, m], where each m-sized spectrum as a wavelength, a flux and a flux error
+        wavelength, flux, err - Views of size [4, m] of the wavelength, flux and flux error rows of trace_spectra
         pol_spectra - An array of size [3,3, m], where each m-sized spectrum as a wavelength, a flux and a flux error
         calibrated_pol_spectra - An array of size [5,3, m], where each m-sized spectrum as a wavelength, a flux and a flux error
         Q - an array of size 3,m, where each m sized stokes-Q has a wavelength, stokes Q  and Q error
@@ -1073,6 +1126,10 @@ class wircpol_source(object):
 
 
     """
+    #fig_num -> (figure, images, plot options) of the figures set up by plot_cutouts, so they can be redrawn in place.
+    #Entries of figures that have been closed are dropped on the next plot_cutouts.
+    _cutout_figures = {}
+
     def __init__(self, pos, slit_pos, index):
 
         #The source position
@@ -1110,24 +1167,43 @@ class wircpol_source(object):
         self.spectra_aligned = False
         self.thumbnails_cut_out = False #source attribute, later applied to header["THMB_CUT"]
 
+    #Views of the rows of trace_spectra, shape [4, m] each. Writing to them writes to trace_spectra.
+    @property
+    def wavelength(self):
+        return self.trace_spectra[:,0,:]
+
+    @property
+    def flux(self):
+        return self.trace_spectra[:,1,:]
+
+    @property
+    def err(self):
+        return self.trace_spectra[:,2,:]
+
 
     #def get_cutouts(self, image, image_DQ, filter_name, replace_bad_pixels = True, method = 'median', box_size = 5, cutout_size = None, sub_bar=True, verbose=False):
     def get_cutouts(self, image, image_DQ, filter_name, image_bkg_fn = None, replace_bad_pixels = True, method = 'median', \
-                    box_size = 5, cutout_size = None, sub_bar=True, verbose=False):
+                    box_size = 5, cutout_size = None, sub_bar=True, verbose=False, trace_images = None, trace_images_DQ = None):
         """
         Cutout thumbnails and put them into self.trace_images
         if replace_bad_pixels = True, read teh DQ image and replace pixels with value != 0 by interpolation
         method can be 'median' or 'interpolate'
+        trace_images, trace_images_DQ - thumbnails that were already cut out of image and image_DQ (e.g. by wirc_data.get_source_cutouts
+                        for all the sources at once). If None they are cut out here.
 
 
         """
         locs = [int(self.pos[0]),int(self.pos[1])]
 
-        self.trace_images = np.array(image_utils.cutout_trace_thumbnails(image, np.expand_dims([locs, self.slit_pos],axis=0), flip=False,filter_name = filter_name,
-            cutout_size= cutout_size, sub_bar = sub_bar, verbose=verbose)[0])
+        if trace_images is None:
+            trace_images = image_utils.cutout_trace_thumbnails(image, _thumbnail_locations(locs, self.slit_pos), flip=False,filter_name = filter_name,
+                cutout_size= cutout_size, sub_bar = sub_bar, verbose=verbose)[0]
+        self.trace_images = np.array(trace_images)
         try:
-            self.trace_images_DQ = np.array(image_utils.cutout_trace_thumbnails(image_DQ, np.expand_dims([locs, self.slit_pos],axis=0), flip=False,filter_name = filter_name,
-            cutout_size= cutout_size, sub_bar = False, verbose = verbose)[0])
+            if trace_images_DQ is None:
+                trace_images_DQ = image_utils.cutout_trace_thumbnails(image_DQ, _thumbnail_locations(locs, self.slit_pos), flip=False,filter_name = filter_name,
+                cutout_size= cutout_size, sub_bar = False, verbose = verbose)[0]
+            self.trace_images_DQ = np.array(trace_images_DQ)
         except:
             if verbose:
                 print("Could not cutout data quality (DQ) thumbnails. Assuming everything is good.")
@@ -1161,7 +1237,7 @@ class wircpol_source(object):
         #Deal with background frame
         if image_bkg_fn is not None:         
             bkg_im = fits.open(image_bkg_fn)[0].data #assume wirc image 
-            self.trace_bkg = np.array(image_utils.cutout_trace_thumbnails(bkg_im, np.expand_dims([locs, self.slit_pos],axis=0), flip=False,filter_name = filter_name,   
+            self.trace_bkg = np.array(image_utils.cutout_trace_thumbnails(bkg_im, _thumbnail_locations(locs, self.slit_pos), flip=False,filter_name = filter_name,   
                                 cutout_size= cutout_size, sub_bar = sub_bar, verbose=verbose)[0])   
             if replace_bad_pixels: 
                 #check method   
@@ -1187,7 +1263,7 @@ class wircpol_source(object):
 
         locs = [int(self.pos[0]),int(self.pos[1])]
 
-        self.trace_bkg = np.array(image_utils.cutout_trace_thumbnails(bkg_image, np.expand_dims([locs, self.slit_pos],axis=0), flip=False,
+        self.trace_bkg = np.array(image_utils.cutout_trace_thumbnails(bkg_image, _thumbnail_locations(locs, self.slit_pos), flip=False,
             filter_name = filter_name, cutout_size= cutout_size, sub_bar = sub_bar, verbose=verbose)[0])   
 
 
@@ -1218,7 +1294,7 @@ class wircpol_source(object):
 
         locs = [int(self.pos[0]),int(self.pos[1])]
 
-        self.trace_bkg = np.array(image_utils.cutout_trace_thumbnails(self.bkg_image, np.expand_dims([locs, self.slit_pos],axis=0), flip=False,
+        self.trace_bkg = np.array(image_utils.cutout_trace_thumbnails(self.bkg_image, _thumbnail_locations(locs, self.slit_pos), flip=False,
             filter_name = filter_name, cutout_size= cutout_size, sub_bar = sub_bar, verbose=verbose)[0])   
 
 
@@ -1251,14 +1327,9 @@ class wircpol_source(object):
 
         if not show:
             default_back = matplotlib.get_backend()
-            plt.switch_backend('Agg')
-
-        #Would you like to choose the specific figure that we're using?
-        if fig_num is not None:
-            fig = plt.figure(fig_num,figsize=figsize)
-            plt.clf()
-        else: #If not, then we'll make a new figure.
-            fig = plt.figure(figsize=figsize)
+            #switching backends closes every figure, so don't when we're already on Agg (e.g. in a batch run)
+            if default_back.lower() != 'agg':
+                plt.switch_backend('Agg')
 
         #What to plot?          
         if plot_dq:           
@@ -1267,11 +1338,55 @@ class wircpol_source(object):
             to_plot = self.trace_images - self.trace_bkg    
         else:         
             to_plot = self.trace_images         
-        
+
+        #If this figure already shows cutouts of the same size with the same options (e.g. plotting source after source
+        #into the same fig_num), just swap in the new images rather than rebuilding the axes and colorbar
+        #forget the figures that have been closed since, so that they can be garbage collected
+        for num in [num for num in wircpol_source._cutout_figures if not plt.fignum_exists(num)]:
+            del wircpol_source._cutout_figures[num]
+
+        plot_options = (origin, repr(sorted(kwargs.items())))
+        cached = wircpol_source._cutout_figures.get(fig_num) if fig_num is not None else None
+        reuse = cached is not None and plt.fignum_exists(fig_num) and cached[0] is plt.figure(fig_num) \
+                and cached[2] == plot_options and cached[1][0].get_array().shape == to_plot[0].shape
+
+        if reuse:
+            images = cached[1]
+            for i in range(4):
+                images[i].set_data(to_plot[i,:,:])
+                if 'vmin' not in kwargs and 'vmax' not in kwargs and 'norm' not in kwargs:
+                    images[i].autoscale()
+            plt.sca(images[-1].axes)
+            plt.sci(images[-1])
+        else:
+            self._build_cutout_figure(to_plot, fig_num, figsize, origin, plot_options, **kwargs)
+
+        if output_name != '':
+            plt.savefig(output_name, format='png')
+        if show:
+            plt.show()
+        else:
+            if default_back.lower() != 'agg':
+                plt.switch_backend(default_back)
+
+    def _build_cutout_figure(self, to_plot, fig_num, figsize, origin, plot_options, **kwargs):
+        '''
+        Set up the four panels and colorbar for plot_cutouts. When fig_num is given the figure is remembered, so
+        that the next plot_cutouts into it only has to swap in the new images.
+        '''
+
+        #Would you like to choose the specific figure that we're using?
+        if fig_num is not None:
+            fig = plt.figure(fig_num,figsize=figsize)
+            plt.clf()
+        else: #If not, then we'll make a new figure.
+            fig = plt.figure(figsize=figsize)
+
         texts = ['Top - Left', 'Bottom - Right', 'Top - Right', 'Bottom - Left']        
+        images = []
         for i in range(4):        
             ax = fig.add_subplot(1,4,i+1)             
-            plt.imshow(to_plot[i,:,:], origin = origin , **kwargs)         
+            images.append(plt.imshow(to_plot[i,:,:], origin = origin , **kwargs))
             plt.text(5,140, texts[i], color = 'w')             
             ax.set_yticklabels([])
 
@@ -1311,18 +1426,16 @@ class wircpol_source(object):
         cbar_ax = fig.add_axes([0.90, 0.38, 0.03, 0.24])
         plt.colorbar(cax = cbar_ax)
 
-        if output_name != '':
-            plt.savefig(output_name, format='png')
-        if show:
-            plt.show()
-        else:
-            plt.switch_backend(default_back)
+        if fig_num is not None:
+            wircpol_source._cutout_figures[fig_num] = (fig, images, plot_options)
 
     def plot_extracted_cutouts(self, output_name='', show=True, **kwargs):
 
         if not show:
             default_back = matplotlib.get_backend()
-            plt.switch_backend('Agg')
+            #switching backends closes every figure, so don't when we're already on Agg (e.g. in a batch run)
+            if default_back.lower() != 'agg':
+                plt.switch_backend('Agg')
 
         fig = plt.figure(figsize = (12,8))
 
@@ -1355,7 +1468,8 @@ class wircpol_source(object):
         if show:
             plt.show()
         else:
-            plt.switch_backend(default_back)
+            if default_back.lower() != 'agg':
+                plt.switch_backend(default_back)
 
     def clean_cutouts_for_cosmic_rays(self,nsig=10, method='lacosmic'):
         '''
@@ -1369,7 +1483,7 @@ class wircpol_source(object):
     def extract_spectra(self, bkg_poly_order = 2, plot=False, bkg_thumbnails = None, plot_optimal_extraction = False, plot_findTrace = False,
         method = 'optimal_extraction', spatial_sigma = 5, fixed_width = None, lamda_sigma=10, width_scale=1., diag_mask=False, bad_pix_masking = 0, niter = 2,
         sig_clip = 5, trace_angle = None, fitfunction = 'Moffat', sum_method = 'weighted_sum', box_size = 1, poly_order = 4, align = True, verbose=True,
-        use_DQ=True, debug_DQ=False, s=1, spectral_smooth=10, spatial_smooth=1):
+        use_DQ=True, debug_DQ=False, s=1, spectral_smooth=10, spatial_smooth=1, dtype=np.float32):
         """
         *method:        method for spectral extraction. Choices are
         (i) skimage: this is just the profile_line method from skimage. Order for interpolation
@@ -1384,6 +1498,8 @@ class wircpol_source(object):
         box_size determine how many columns of pixel we will use. poly_order is the order of polynomial used to
         fit the background. trace_angle is the angle to rotate the cutout so it's aligned with the pixel grid.
         If None, it uses value from fitTraces.
+        dtype is the data type of the resulting trace_spectra. float32 is plenty for the detector counts, use np.float64
+        if you need the extra precision.
 
         """
         if verbose:
@@ -1403,10 +1519,9 @@ class wircpol_source(object):
         spectra_length = spectra.shape[1]
 
         #set values
-        self.trace_spectra = np.zeros((4,3,spectra_length))
-        self.trace_spectra[:,0,:] = np.arange(spectra_length) #The wavelength axis, to be calibrated later.
-        self.trace_spectra[:,1,:] = spectra
-        self.trace_spectra[:,2,:] = spectra_std
+        #The wavelength axis, to be calibrated later, then the flux and its error, built in one go
+        wl_axis = np.broadcast_to(np.arange(spectra_length, dtype = dtype), spectra.shape)
+        self.trace_spectra = np.stack([wl_axis, np.asarray(spectra, dtype = dtype), np.asarray(spectra_std, dtype = dtype)], axis = 1)
 
         self.spectra_extracted = True #source attribute, later applied to header["SPC_XTRD"]
         self.spectra_aligned = align
@@ -1423,8 +1538,8 @@ class wircpol_source(object):
         Only the 2nd-order polynomical shift is then used
         '''
         if self.lambda_calibrated:
-            lowcut = np.where(self.trace_spectra[0,0,:] > 1.20)[0][0]
-            highcut = np.where(self.trace_spectra[0,0,:] > 1.30)[0][0]
+            lowcut = np.where(self.wavelength[0] > 1.20)[0][0]
+            highcut = np.where(self.wavelength[0] > 1.30)[0][0]
             print(highcut)
 
         self.trace_spectra = spec_utils.align_spectra(self.trace_spectra, lowcut=lowcut,
@@ -1443,34 +1558,29 @@ class wircpol_source(object):
         """
         aligned = self.spectra_aligned
 
-        if aligned: #do wavelength calibration to Qp, then apply it to eveerything else
-            if method == 1:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[0,1,:], filter_name)
-                self.trace_spectra[1,0,:] = self.trace_spectra[0,0,:]
-                self.trace_spectra[2,0,:] = self.trace_spectra[0,0,:]
-                self.trace_spectra[3,0,:] = self.trace_spectra[0,0,:]
-            if method == 2:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[0,1,:], filter_name, lowcut=lowcut, highcut=highcut)
-                self.trace_spectra[1,0,:] = self.trace_spectra[0,0,:]
-                self.trace_spectra[2,0,:] = self.trace_spectra[0,0,:]
-                self.trace_spectra[3,0,:] = self.trace_spectra[0,0,:]
+        #The wavelength solution of a single trace, for each method (method 3 is v2 on the first trace only)
+        calibrations = {1: spec_utils.rough_wavelength_calibration_v1,
+                        2: partial(spec_utils.rough_wavelength_calibration_v2, lowcut=lowcut, highcut=highcut),
+                        3: partial(spec_utils.rough_wavelength_calibration_v2, lowcut=lowcut, highcut=highcut)}
+        if method not in calibrations:
+            raise ValueError("{} is not a valid method. Choose from 1, 2 or 3.".format(method))
+        calibrate = calibrations[method]
 
-        else:
-            if method == 1:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[0,1,:], filter_name)
-                self.trace_spectra[1,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[1,1,:], filter_name)
-                self.trace_spectra[2,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[2,1,:], filter_name)
-                self.trace_spectra[3,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[3,1,:], filter_name)
+        if method == 3:
+            self.wavelength[0] = calibrate(self.flux[0], filter_name)
 
+        elif aligned: #do wavelength calibration to Qp, then apply it to eveerything else
+            #the aligned traces share one wavelength solution, broadcast into all four rows in a single write
+            self.wavelength[:] = calibrate(self.flux[0], filter_name)
 
-            elif method == 2:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[0,1,:], filter_name, lowcut=lowcut, highcut=highcut)
-                self.trace_spectra[1,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[1,1,:], filter_name, lowcut=lowcut, highcut=highcut)
-                self.trace_spectra[2,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[2,1,:], filter_name, lowcut=lowcut, highcut=highcut)
-                self.trace_spectra[3,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[3,1,:], filter_name, lowcut=lowcut, highcut=highcut)
+        elif method == 2:
+            #all four traces at once
+            self.wavelength[:] = spec_utils.rough_wavelength_calibration_v2_batch(self.flux, filter_name, lowcut=lowcut, highcut=highcut)
 
-        if method == 3:
-            self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[0,1,:], filter_name, lowcut=lowcut, highcut=highcut)
+        else:
+            #each trace is a separate fit to the filter transmission
+            for i in range(4):
+                self.wavelength[i] = calibrate(self.flux[i], filter_name)
 
         self.lambda_calibrated = True #source attribute, later applied to header["WL_CBRTD"]
 
@@ -1483,8 +1593,10 @@ class wircpol_source(object):
             self.pos[0],verbose=verbose, plot_alignment = plot_alignment, tilt_angle = tilt_angle, source_compensation = source_compensation)
         self.lambda_calibrated = True
 
-    def compute_polarization(self, cutmin=0, cutmax=-1):
-
+    def compute_polarization(self, cutmin=0, cutmax=-1, dtype=np.float32):
+        '''
+        Compute stokes Q and U from the trace spectra, into self.Q and self.U. dtype is their data type.
+        '''
 
         ## The output of the computer_polarization function is based on the initial assumptions on Q and U, which we know are wrong.
         ## We will keep the compute_polarization the same, but change it when putting it into the source object.
@@ -1492,8 +1604,9 @@ class wircpol_source(object):
 
         pol_spectra_length = q.shape[0]
 
-        self.Q = np.zeros([3,pol_spectra_length])
-        self.U = np.zeros([3,pol_spectra_length])
+        #every row is filled in below
+        self.Q = np.empty([3,pol_spectra_length], dtype=dtype)
+        self.U = np.empty([3,pol_spectra_length], dtype=dtype)
 
         ##### OLD VERSION ######
         # self.Q[0,:] = wlQp
@@ -1523,7 +1636,9 @@ class wircpol_source(object):
 
         if not show:
             default_back = matplotlib.get_backend()
-            plt.switch_backend('Agg')
+            #switching backends closes every figure, so don't when we're already on Agg (e.g. in a batch run)
+            if default_back.lower() != 'agg':
+                plt.switch_backend('Agg')
 
         #Would you like to choose the specific figure that we're using?
         if fig_num is not None:
@@ -1532,19 +1647,19 @@ class wircpol_source(object):
         else:
             fig = plt.figure(figsize=figsize)
 
-        labels = ["Top-Left", "Bottom-Right", "Top-Right", "Bottom-left"]
-        for i in range(4):
-            wl = self.trace_spectra[i,0,:]
-            flux = self.trace_spectra[i,1,:]
-            err = self.trace_spectra[i,2,:]
-            if smooth_size > 1:
-                flux = spec_utils.smooth_spectra(flux, smooth_ker, smooth_size)
-            if with_errors:
-                plt.errorbar(wl, flux,yerr = err, label=labels[i], **kwargs)
+        #smooth all four fluxes in one go
+        fluxes = spec_utils.smooth_spectra(self.flux, smooth_ker, smooth_size)
 
-            else:
-                plt.plot(wl, flux, label=labels[i], **kwargs)
-            plt.draw()
+        labels = ["Top-Left", "Bottom-Right", "Top-Right", "Bottom-left"]
+        if with_errors: #errorbar only takes one spectrum at a time
+            for i in range(4):
+                plt.errorbar(self.wavelength[i], fluxes[i], yerr = self.err[i], label=labels[i], **kwargs)
+        else:
+            #one line per column, all four traces in a single call
+            lines = plt.plot(self.wavelength.T, fluxes.T, **kwargs)
+            for line, label in zip(lines, labels):
+                line.set_label(label)
+        plt.draw()
 
         plt.ylabel("Flux [ADU]")
 
@@ -1571,13 +1686,16 @@ class wircpol_source(object):
             plt.savefig(output_name, format='png')
 
         if not show:
-            plt.switch_backend(default_back)
+            if default_back.lower() != 'agg':
+                plt.switch_backend(default_back)
 
     def plot_Q_and_U(self, with_errors = False, figsize=(7,7), xlow=1.15, xhigh=1.35, ylow=-0.2, yhigh=0.2, output_name='', show=True, **kwargs):
 
         if not show:
             default_back = matplotlib.get_backend()
-            plt.switch_backend('Agg')
+            #switching backends closes every figure, so don't when we're already on Agg (e.g. in a batch run)
+            if default_back.lower() != 'agg':
+                plt.switch_backend('Agg')
 
         fig = plt.figure(figsize=figsize)
 
@@ -1609,7 +1727,8 @@ class wircpol_source(object):
             plt.savefig(output_name, format='png')
 
         if not show:
-            plt.switch_backend(default_back)
+            if default_back.lower() != 'agg':
+                plt.switch_backend(default_back)
 
     def get_broadband_polarization(self, mode ='from_spectra',xlow=0, xhigh=-1, weighted=False, x_stretch=1, y_stretch=1, verbose=False, plot=False):
         '''
@@ -1623,13 +1742,13 @@ class wircpol_source(object):
             for i in range(4):
                 #Do we actualy want the option of weighted mean?
                 if weighted:
-                    bb_traces[i,0] = np.average(self.trace_spectra[i,0,xlow:xhigh]) #Don't weight the wavelength
-                    bb_traces[i,1] = np.average(self.trace_spectra[i,1,xlow:xhigh], weights=1/self.trace_spectra[i,2,xlow:xhigh])
-                    bb_traces[i,2] = np.sqrt(np.sum(self.trace_spectra[i,2,xlow:xhigh]**2)/np.size(self.trace_spectra[i,2,xlow:xhigh])**2) #This isn't the correct error formula for weighted means
+                    bb_traces[i,0] = np.average(self.wavelength[i,xlow:xhigh]) #Don't weight the wavelength
+                    bb_traces[i,1] = np.average(self.flux[i,xlow:xhigh], weights=1/self.err[i,xlow:xhigh])
+                    bb_traces[i,2] = np.sqrt(np.sum(self.err[i,xlow:xhigh]**2)/np.size(self.err[i,xlow:xhigh])**2) #This isn't the correct error formula for weighted means
                 else:
-                    bb_traces[i,0] = np.average(self.trace_spectra[i,0,xlow:xhigh]) 
-                    bb_traces[i,1] = np.average(self.trace_spectra[i,1,xlow:xhigh])
-                    bb_traces[i,2] = np.sqrt(np.sum(self.trace_spectra[i,2,xlow:xhigh]**2)/np.size(self.trace_spectra[i,2,xlow:xhigh])**2)
+                    bb_traces[i,0] = np.average(self.wavelength[i,xlow:xhigh]) 
+                    bb_traces[i,1] = np.average(self.flux[i,xlow:xhigh])
+                    bb_traces[i,2] = np.sqrt(np.sum(self.err[i,xlow:xhigh]**2)/np.size(self.err[i,xlow:xhigh])**2)
 
             
             ## The calculations of bbQ and bbU are based on the initial assumptions on Q and U, which we know are wrong. 
@@ -1754,11 +1873,11 @@ class wircspec_source(object):
         """
 
         locs = [int(self.pos[0]),int(self.pos[1])]
-        self.trace_images = np.array(image_utils.cutout_trace_thumbnails(image, np.expand_dims([locs, self.slit_pos],axis=0), flip=flip,filter_name = filter_name, sub_bar = sub_bar, mode = 'spec', cutout_size = cutout_size, verbose=verbose)[0])
+        self.trace_images = np.array(image_utils.cutout_trace_thumbnails(image, _thumbnail_locations(locs, self.slit_pos), flip=flip,filter_name = filter_name, sub_bar = sub_bar, mode = 'spec', cutout_size = cutout_size, verbose=verbose)[0])
         if image_DQ is not None:
 
             try:
-                self.trace_images_DQ = np.array(image_utils.cutout_trace_thumbnails(image_DQ, np.expand_dims([locs, self.slit_pos],axis=0), flip=flip,\
+                self.trace_images_DQ = np.array(image_utils.cutout_trace_thumbnails(image_DQ, _thumbnail_locations(locs, self.slit_pos), flip=flip,\
                                         filter_name = filter_name, sub_bar = sub_bar, mode = 'spec', cutout_size = cutout_size, verbose = verbose)[0])
             except:
                 if verbose:
@@ -1793,7 +1912,7 @@ class wircspec_source(object):
     def extract_spectra(self, sub_background = False, plot=False, plot_optimal_extraction = False, plot_findTrace = False,
                          method = 'optimal_extraction', bad_pix_masking = 0, width_scale=1., diag_mask=False, filter_bkg_size = None,\
                         fitfunction = 'Moffat', sum_method = 'weighted_sum', trace_angle = None, box_size = 1, poly_order = 4, align = True, verbose = True,
-                        fractional_fit_type = None, bkg_sub_shift_size = 21, bkg_poly_order = 0, spatial_sigma = 3):
+                        fractional_fit_type = None, bkg_sub_shift_size = 21, bkg_poly_order = 0, spatial_sigma = 3, dtype = np.float32):
         """
         *method:        method for spectral extraction. Choices are
         (i) skimage: this is just the profile_line method from skimage. Order for interpolation
@@ -1809,6 +1928,8 @@ class wircspec_source(object):
         fit the background.
         trace_angle is the angle used to rotate the spectral trace for the fit_across_trace method; None uses the
         measured angle for each individual spectrum
+        dtype is the data type of the resulting trace_spectra. float32 is plenty for the detector counts, use np.float64
+        if you need the extra precision.
         """
         if verbose:
             print("Performing Spectral Extraction for source {}".format(self.index))
@@ -1833,10 +1954,9 @@ class wircspec_source(object):
         #plt.show()
         spectra_length = spectra.shape[1]
 
-        self.trace_spectra = np.zeros((1,3,spectra_length))
-        self.trace_spectra[:,0,:] = np.arange(spectra_length) #The wavelength axis, to be calibrated later.
-        self.trace_spectra[:,1,:] = spectra
-        self.trace_spectra[:,2,:] = spectra_std
+        #The wavelength axis, to be calibrated later, then the flux and its error, built in one go
+        wl_axis = np.broadcast_to(np.arange(spectra_length, dtype = dtype), spectra.shape)
+        self.trace_spectra = np.stack([wl_axis, np.asarray(spectra, dtype = dtype), np.asarray(spectra_std, dtype = dtype)], axis = 1)
 
         self.spectra_extracted = True #source attribute, later applied to header["SPC_XTRD"]
         self.spectra_aligned = align
@@ -1857,19 +1977,13 @@ class wircspec_source(object):
         #TODO: It would be good to have lowcut and highcut only apply to the calculation, and not affect the data at this point (I think)
 
         """
-        aligned = self.spectra_aligned
+        #there is only the one trace to calibrate, aligned or not
+        calibrations = {1: spec_utils.rough_wavelength_calibration_v1,
+                        2: partial(spec_utils.rough_wavelength_calibration_v2, lowcut=lowcut, highcut=highcut)}
+        if method not in calibrations:
+            raise ValueError("{} is not a valid method. Choose from 1 or 2.".format(method))
 
-        if aligned:
-            if method == 1:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[0,1,:], filter_name)
-            if method == 2:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[0,1,:], filter_name, lowcut=lowcut, highcut=highcut)
-
-        else:
-            if method == 1:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v1(self.trace_spectra[0,1,:], filter_name)
-            elif method == 2:
-                self.trace_spectra[0,0,:] = spec_utils.rough_wavelength_calibration_v2(self.trace_spectra[0,1,:], filter_name, lowcut=lowcut, highcut=highcut)
+        self.trace_spectra[0,0,:] = calibrations[method](self.trace_spectra[0,1,:], filter_name)
 
         self.lambda_calibrated = True #source attribute, later applied to header["WL_CBRTD"]
 
@@ -1885,7 +1999,7 @@ class wircspec_source(object):
             if smooth_size > 1:
                 flux = spec_utils.smooth_spectra(flux, smooth_ker, smooth_size)
             if with_errors:
-                plt.errobar(wl, flux,yerr = err, **kwargs) #label=labels[i]
+                plt.errorbar(wl, flux,yerr = err, **kwargs) #label=labels[i]
 
             else:
                 plt.plot(wl, flux, **kwargs) #label=labels[i],